@@ -0,0 +1,388 @@
+import os
+import sys
+import json
+import shutil
+import timeit
+import argparse
+import platform
+import tempfile
+import tracemalloc
+
+from highball.api import API
+from highball.middleware import Middleware
+from highball.orm import Column, Database, ForeignKey, Table
+
+ROUTE_COUNTS = (10, 100, 1000)
+TABLE_SIZES = (10, 100, 1000)
+MIDDLEWARE_DEPTHS = (0, 1, 8)
+DEFAULT_MARGIN = 0.25
+
+BENCHMARKS = {}
+MEMORY_BENCHMARKS = {}
+METRICS = ("seconds_per_op", "bytes_per_row")
+
+
+def benchmark(name):
+    def wrapper(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return wrapper
+
+
+def memory_benchmark(name):
+    def wrapper(setup):
+        MEMORY_BENCHMARKS[name] = setup
+        return setup
+    return wrapper
+
+
+def _start_response(status, headers, exc_info=None):
+    pass
+
+
+def wsgi_call(app, path, method="GET", **environ):
+    base = {"REQUEST_METHOD": method, "PATH_INFO": path, "SERVER_NAME": "bench", "SERVER_PORT": "80"}
+    base.update(environ)
+
+    def call():
+        body = app(dict(base), _start_response)
+        for _ in body:
+            pass
+        if hasattr(body, "close"):
+            body.close()
+    return call
+
+
+def _api(workdir, **kwargs):
+    kwargs.setdefault("templates_dir", os.path.join(workdir, "templates"))
+    kwargs.setdefault("static_dir", os.path.join(workdir, "static"))
+    return API(**kwargs)
+
+
+def _add_routes(api, count):
+    for i in range(count):
+        if i % 2:
+            api.add_route(f"/static-{i}/items", _text_handler)
+        else:
+            api.add_route(f"/param-{i}/{{id:d}}", _param_handler)
+
+
+def _text_handler(req, resp):
+    resp.text = "hello"
+
+
+def _param_handler(req, resp, id):
+    resp.text = "hello"
+
+
+def _register_routing(count):
+    @benchmark(f"routing/{count}-routes/hit")
+    def hit(workdir):
+        api = _api(workdir)
+        _add_routes(api, count)
+        return wsgi_call(api, f"/param-{count - 2}/42")
+
+    @benchmark(f"routing/{count}-routes/404")
+    def miss(workdir):
+        api = _api(workdir)
+        _add_routes(api, count)
+        return wsgi_call(api, "/does/not/exist")
+
+
+for _count in ROUTE_COUNTS:
+    _register_routing(_count)
+
+
+@benchmark("handlers/function")
+def function_handler(workdir):
+    api = _api(workdir)
+    api.add_route("/books", _text_handler)
+    return wsgi_call(api, "/books")
+
+
+@benchmark("handlers/class")
+def class_handler(workdir):
+    class BooksResource:
+        def get(self, req, resp):
+            resp.text = "hello"
+
+    api = _api(workdir)
+    api.add_route("/books", BooksResource)
+    return wsgi_call(api, "/books")
+
+
+@benchmark("handlers/405")
+def method_not_allowed(workdir):
+    api = _api(workdir)
+    api.add_route("/books", _text_handler, allowed_methods=["post"])
+    return wsgi_call(api, "/books")
+
+
+@benchmark("responses/text")
+def text_response(workdir):
+    api = _api(workdir)
+    api.add_route("/text", _text_handler)
+    return wsgi_call(api, "/text")
+
+
+@benchmark("responses/json")
+def json_response(workdir):
+    payload = {"books": [{"id": i, "title": f"Book {i}", "published": True} for i in range(20)]}
+
+    def handler(req, resp):
+        resp.json = payload
+
+    api = _api(workdir)
+    api.add_route("/json", handler)
+    return wsgi_call(api, "/json")
+
+
+@benchmark("responses/html")
+def html_response(workdir):
+    html = "<html><body>" + "<p>hello</p>" * 50 + "</body></html>"
+
+    def handler(req, resp):
+        resp.html = html
+
+    api = _api(workdir)
+    api.add_route("/html", handler)
+    return wsgi_call(api, "/html")
+
+
+@benchmark("templates/render")
+def template_render(workdir):
+    with open(os.path.join(workdir, "templates", "list.html"), "w") as f:
+        f.write("<ul>{% for book in books %}<li>{{ book.title }}</li>{% endfor %}</ul>")
+    books = [{"title": f"Book {i}"} for i in range(50)]
+    api = _api(workdir)
+
+    def handler(req, resp):
+        resp.html = api.template("list.html", context={"books": books})
+
+    api.add_route("/books", handler)
+    return wsgi_call(api, "/books")
+
+
+def _register_middleware(depth):
+    @benchmark(f"middleware/depth-{depth}")
+    def middleware(workdir):
+        class Noop(Middleware):
+            def process_request(self, req):
+                pass
+
+            def process_response(self, req, resp):
+                pass
+
+        api = _api(workdir)
+        for _ in range(depth):
+            api.add_middleware(Noop)
+        api.add_route("/books", _text_handler)
+        return wsgi_call(api, "/books")
+
+
+for _depth in MIDDLEWARE_DEPTHS:
+    _register_middleware(_depth)
+
+
+@benchmark("static/file")
+def static_file(workdir):
+    with open(os.path.join(workdir, "static", "main.css"), "w") as f:
+        f.write("body { background-color: red }\n" * 100)
+    api = _api(workdir)
+    return wsgi_call(api, "/static/main.css")
+
+
+def _orm_tables():
+    class Author(Table):
+        name = Column(str)
+        age = Column(int)
+
+    class Book(Table):
+        title = Column(str)
+        published = Column(bool)
+        author = ForeignKey(Author)
+
+    return Author, Book
+
+
+def _orm_setup(workdir, size):
+    db = Database(os.path.join(workdir, f"bench-{size}.db"))
+    Author, Book = _orm_tables()
+    db.create(Author)
+    db.create(Book)
+    db.conn.executemany(
+        "INSERT INTO author (age, name) VALUES (?, ?);",
+        [(20 + i % 50, f"Author {i}") for i in range(size)],
+    )
+    db.conn.executemany(
+        "INSERT INTO book (author_id, published, title) VALUES (?, ?, ?);",
+        [(i % size + 1, i % 2, f"Book {i}") for i in range(size)],
+    )
+    db.conn.commit()
+    return db, Author, Book
+
+
+def _register_orm(size):
+    @benchmark(f"orm/{size}-rows/save")
+    def save(workdir):
+        db, Author, _ = _orm_setup(workdir, size)
+        return lambda: db.save(Author(name="John Doe", age=23))
+
+    @benchmark(f"orm/{size}-rows/save-fk")
+    def save_fk(workdir):
+        db, Author, Book = _orm_setup(workdir, size)
+        author = db.get(Author, id=1)
+        return lambda: db.save(Book(title="Building an ORM", published=True, author=author))
+
+    @benchmark(f"orm/{size}-rows/save-many")
+    def save_many(workdir):
+        db, Author, _ = _orm_setup(workdir, size)
+        return lambda: db.save_many(Author(name="John Doe", age=23) for _ in range(size))
+
+    @benchmark(f"orm/{size}-rows/get")
+    def get(workdir):
+        db, Author, _ = _orm_setup(workdir, size)
+        return lambda: db.get(Author, id=size // 2)
+
+    @benchmark(f"orm/{size}-rows/get-cached")
+    def get_cached(workdir):
+        db, Author, _ = _orm_setup(workdir, size)
+        db.enable_cache()
+        return lambda: db.get(Author, id=size // 2)
+
+    @benchmark(f"orm/{size}-rows/get-fk")
+    def get_fk(workdir):
+        db, _, Book = _orm_setup(workdir, size)
+        return lambda: db.get(Book, id=size // 2)
+
+    @benchmark(f"orm/{size}-rows/all")
+    def all_rows(workdir):
+        db, Author, _ = _orm_setup(workdir, size)
+        return lambda: db.all(Author)
+
+    @benchmark(f"orm/{size}-rows/all-fk")
+    def all_rows_fk(workdir):
+        db, _, Book = _orm_setup(workdir, size)
+        return lambda: db.all(Book)
+
+    @benchmark(f"orm/{size}-rows/all-fk-join")
+    def all_rows_fk_join(workdir):
+        db, _, Book = _orm_setup(workdir, size)
+        return lambda: db.all(Book, related="join")
+
+
+    @benchmark(f"orm/{size}-rows/hydrate")
+    def hydrate(workdir):
+        db, Author, _ = _orm_setup(workdir, size)
+        rows = db.conn.execute(Author._schema.select_all_sql).fetchall()
+        return lambda: db._hydrate(Author, rows, {}, "prefetch")
+
+    @memory_benchmark(f"orm/{size}-rows/memory")
+    def memory(workdir):
+        db, Author, _ = _orm_setup(workdir, size)
+        return lambda: db.all(Author), size
+
+
+for _size in TABLE_SIZES:
+    _register_orm(_size)
+
+
+# best of `repeat` runs, each one long enough (about 0.2s) to be stable
+def measure(setup, repeat=3):
+    workdir = tempfile.mkdtemp(prefix="highball-bench-")
+    try:
+        os.makedirs(os.path.join(workdir, "templates"))
+        os.makedirs(os.path.join(workdir, "static"))
+        operation = setup(workdir)
+        timer = timeit.Timer(operation)
+        number, _ = timer.autorange()
+        best = min(timer.repeat(repeat=repeat, number=number)) / number
+        return {"seconds_per_op": best, "ops_per_second": 1 / best, "iterations": number}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+# memory held by the objects a call returns, per row
+def measure_memory(setup):
+    workdir = tempfile.mkdtemp(prefix="highball-bench-")
+    try:
+        os.makedirs(os.path.join(workdir, "templates"))
+        os.makedirs(os.path.join(workdir, "static"))
+        operation, rows = setup(workdir)
+        operation()
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            result = operation()
+            used = tracemalloc.get_traced_memory()[0] - before
+        finally:
+            tracemalloc.stop()
+        del result
+        return {"bytes_per_row": used / rows, "rows": rows}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare(results, baseline, margin):
+    regressions = []
+    for name, result in sorted(results.items()):
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        for metric in METRICS:
+            if metric in result and metric in expected and result[metric] > expected[metric] * (1 + margin):
+                regressions.append((name, metric, expected[metric], result[metric]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark highball through its WSGI callable.")
+    parser.add_argument("-k", "--filter", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("-o", "--output", default="benchmarks/results.json")
+    parser.add_argument("-b", "--baseline", default="benchmarks/baseline.json")
+    parser.add_argument("-m", "--margin", type=float, default=DEFAULT_MARGIN,
+                        help="allowed slowdown over the baseline, 0.25 is 25%%")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name, setup in BENCHMARKS.items():
+        if args.filter not in name:
+            continue
+        results[name] = measure(setup, repeat=args.repeat)
+        print(f"{name:<40} {results[name]['seconds_per_op'] * 1e6:>12.2f} us/op")
+    for name, setup in MEMORY_BENCHMARKS.items():
+        if args.filter not in name:
+            continue
+        results[name] = measure_memory(setup)
+        print(f"{name:<40} {results[name]['bytes_per_row']:>12.0f} bytes/row")
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save-baseline to create one")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)["results"]
+    regressions = compare(results, baseline, args.margin)
+    for name, metric, expected, actual in regressions:
+        print(f"REGRESSION {name} {metric}: {expected:.6g} -> {actual:.6g}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
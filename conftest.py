@@ -9,7 +9,7 @@ def api():
 
 @pytest.fixture
 def client(api):
-    return api.test_session()
+    return api.test_client()
 
 @pytest.fixture
 def db():
@@ -1,35 +1,102 @@
-import os
+import asyncio
 import inspect
-from parse import parse
-from webob import Request
+import contextvars
+import functools
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
 from requests import Session as RequestSession
 from wsgiadapter import WSGIAdapter as RequestWSGIAdapter
-from jinja2 import Environment, FileSystemLoader
-from whitenoise import WhiteNoise
-from .middleware import Middleware
+from .asgi import build_environ, lifespan, read_body, send_wsgi_response
+from .metrics import DEFAULT_BUCKETS, UNMATCHED_ROUTE, Metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from .middleware import Pipeline
+from .profiling import PROFILE_HEADER, Profiler, SlowRequestLog, begin_trace, end_trace
+from .request import Request
 from .response import Response
+from .router import Route, Router
+from .static import StaticFiles
+from .templates import Templates
+from .testing import DEFAULT_BASE_URL, TestClient
 
 class API:
-    def __init__(self, templates_dir="templates", static_dir="static"):
-        self._routes = {}
-        self._templates_env = Environment(
-            loader=FileSystemLoader(os.path.abspath(templates_dir))
-        )
+    def __init__(self, templates_dir="templates", static_dir="static", max_threads=None,
+                 json_encoder=None, templates_mode="development", templates_cache_dir=None,
+                 static_build_dir=None):
+        self._routes = Router()
+        self.templates = Templates(templates_dir, mode=templates_mode, cache_dir=templates_cache_dir)
+        self._templates_env = self.templates.env
         
         self.exception_handler = None
         
-        self.whitenoise = WhiteNoise(self.wsgi_app, root=static_dir)
+        self.static = StaticFiles(self.wsgi_app, static_dir=static_dir, build_dir=static_build_dir)
+        self.whitenoise = self.static.whitenoise
+        self.mount(self.static.url_prefix, self.static)
+        self.templates.env.globals["static"] = self.static.url
         
-        self.middleware = Middleware(self)
+        self.middleware = Pipeline(self)
+        
+        self.metrics = None
+        self.profiler = None
+        self.slow_request_log = None
+        self._instrumented = False
+        
+        self.json_encoder = json_encoder
+        self.max_threads = max_threads
+        self._executor = None
 
-    def __call__(self, environ, start_response):
-        path_info = environ["PATH_INFO"]
+    def __call__(self, environ, start_response, send=None):
+        if send is not None:
+            return self.asgi(scope=environ, receive=start_response, send=send)
+        
+        mount, prefix, path_info = self._routes.match_mount(environ["PATH_INFO"])
+        if mount is not None:
+            environ["SCRIPT_NAME"] = environ.get("SCRIPT_NAME", "") + prefix
+            environ["PATH_INFO"] = path_info
+            return mount(environ, start_response)
         
-        if path_info.startswith("/static"):
-            environ["PATH_INFO"] = path_info[len("/static"):]
-            return self.whitenoise(environ=environ, start_response=start_response)
+        request = Request(environ)
+        if self._instrumented:
+            return self._instrumented_call(request, environ, start_response)
+        
+        response = self.middleware.handle_request(request)
         
-        return self.middleware(environ=environ, start_response=start_response)
+        return response(environ, start_response)
+    
+    def _instrumented_call(self, request, environ, start_response):
+        trace = begin_trace(request, self.profiler, self.slow_request_log)
+        status = 500
+        try:
+            started = perf_counter()
+            response = self.middleware.handle_request(request)
+            self._record_middleware_time(request, started)
+            
+            serializing = perf_counter()
+            body = response(environ, start_response)
+            request.timings["serialization"] = perf_counter() - serializing
+            status = response.status_code
+            return body
+        finally:
+            self._finish_trace(request, trace, status)
+            
+    def _record_middleware_time(self, request, started):
+        timings = request.timings
+        elapsed = perf_counter() - started - timings.get("routing", 0) - timings.get("handler", 0)
+        timings["middleware"] = max(elapsed, 0.0)
+            
+    def _finish_trace(self, request, trace, status):
+        timings = request.timings
+        timings["total"] = end_trace(trace)
+        route, _ = request.match or (None, None)
+        label = self._route_label(route)
+        
+        if trace.profile is not None:
+            self.profiler.stop(trace.profile, request, label)
+        if self.metrics is not None:
+            self.metrics.observe_request(label, request.method, status, timings)
+        if self.slow_request_log is not None and timings["total"] >= self.slow_request_log.threshold:
+            self.slow_request_log.record(request, label, status, timings, trace.queries)
+        
+    def _route_label(self, route):
+        return UNMATCHED_ROUTE if route is None else route.path
     
     def wsgi_app(self, environ, start_response):
         request = Request(environ)
@@ -38,71 +105,196 @@ class API:
 
         return response(environ, start_response)
     
+    async def asgi(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await lifespan(receive, send, on_shutdown=self.shutdown_executor)
+        
+        environ = build_environ(scope, await read_body(receive))
+        mount, prefix, path_info = self._routes.match_mount(environ["PATH_INFO"])
+        if mount is not None:
+            environ["SCRIPT_NAME"] += prefix
+            environ["PATH_INFO"] = path_info
+            return await send_wsgi_response(send, mount, environ, executor=self.executor)
+        
+        request = Request(environ)
+        trace = status = None
+        if self._instrumented:
+            trace = begin_trace(request, self.profiler, self.slow_request_log, deferred=True)
+            status = 500
+        try:
+            started = perf_counter()
+            response = await self.middleware.handle_request_async(request)
+            if trace is not None:
+                self._record_middleware_time(request, started)
+            
+            serializing = perf_counter()
+            executor = self.executor if response.streaming else None
+            await send_wsgi_response(send, response, environ, executor=executor)
+            if trace is not None:
+                request.timings["serialization"] = perf_counter() - serializing
+                status = response.status_code
+        finally:
+            if trace is not None:
+                self._finish_trace(request, trace, status)
+        
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_threads, thread_name_prefix="highball"
+            )
+        return self._executor
+    
+    def shutdown_executor(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+            
+    async def run_in_thread(self, func, *args, **kwargs):
+        context = contextvars.copy_context()
+        call = functools.partial(context.run, func, *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+    
     def test_session(self, base_url="http://testserver"):
         session = RequestSession()
         session.mount(prefix=base_url, adapter=RequestWSGIAdapter(self))
         return session
+
+    def test_client(self, base_url=DEFAULT_BASE_URL):
+        return TestClient(self, base_url=base_url)
         
     def handle_request(self, request):
-        response = Response()
+        response = Response(json_encoder=self.json_encoder)
 
-        handler_data, kwargs = self._find_hadler(request_path=request.path)
+        route, kwargs = self.resolve(request)
+        started = perf_counter()
         try:
-            if handler_data is not None:
-                handler = handler_data["handler"]
-                allowed_methods = handler_data["allowed_methods"]
-                if inspect.isclass(handler):
-                    handler = getattr(handler(), request.method.lower(), None)
-                    if handler is None:
-                        raise AttributeError("Method not allowed", request.method)
+            if route is not None:
+                method = request.method.lower()
+                handler = route.methods.get(method)
+                if handler is None:
+                    self.method_not_allowed_response(response, route)
+                elif method in route.async_methods:
+                    asyncio.run(handler(request, response, **kwargs))
                 else:
-                    if request.method.lower() not in allowed_methods:
-                        raise AttributeError("Method not allowed", request.method)
-                
-                handler(request, response, **kwargs)
+                    handler(request, response, **kwargs)
             else:
                 self.default_response(response)
         except Exception as e:
+            if self.metrics is not None:
+                self.metrics.observe_exception(self._route_label(route), e)
             if self.exception_handler is None:
                 raise e
             else:
                 self.exception_handler(request, response, e)
+        finally:
+            if request.timings is not None:
+                request.timings["handler"] = perf_counter() - started
+            
+        return response
+    
+    async def handle_request_async(self, request):
+        response = Response(json_encoder=self.json_encoder)
+
+        route, kwargs = self.resolve(request)
+        started = perf_counter()
+        try:
+            if route is not None:
+                method = request.method.lower()
+                handler = route.methods.get(method)
+                if handler is None:
+                    self.method_not_allowed_response(response, route)
+                elif request.trace is None:
+                    if method in route.async_methods:
+                        await handler(request, response, **kwargs)
+                    else:
+                        await self.run_in_thread(handler, request, response, **kwargs)
+                elif method in route.async_methods:
+                    with request.trace.profiling():
+                        await handler(request, response, **kwargs)
+                else:
+                    await self.run_in_thread(request.trace.run, handler, request, response, **kwargs)
+            else:
+                self.default_response(response)
+        except Exception as e:
+            if self.metrics is not None:
+                self.metrics.observe_exception(self._route_label(route), e)
+            if self.exception_handler is None:
+                raise e
+            else:
+                result = self.exception_handler(request, response, e)
+                if inspect.isawaitable(result):
+                    await result
+        finally:
+            if request.timings is not None:
+                request.timings["handler"] = perf_counter() - started
             
         return response
 
     def _find_hadler(self, request_path):
-        for path, handler_date in self._routes.items():
-            parse_result = parse(path, request_path)
-            if parse_result is not None:
-                return handler_date, parse_result.named
-        
-        return None, None
+        return self._routes.match(request_path)
     
-    def add_route(self, path, handler, allowed_methods=None):
-        assert path not in self._routes, "Such route already exist"
-        
-        if allowed_methods is None:
-            allowed_methods = ['get', 'post', 'put', 'delete', 'options']
-            
-        self._routes[path] = {"handler": handler, "allowed_methods": allowed_methods}
+    # routing happens once per request, middleware that needs the route and
+    # the handler share the result stored on the request
+    def resolve(self, request):
+        if request.match is None:
+            if request.timings is None:
+                request.match = self._find_hadler(request_path=request.path)
+            else:
+                started = perf_counter()
+                request.match = self._find_hadler(request_path=request.path)
+                request.timings["routing"] = perf_counter() - started
+        return request.match
+    
+    def add_route(self, path, handler, allowed_methods=None, instance="request"):
+        self._routes.add(Route(path, handler, allowed_methods, instance))
 
-    def route(self, path, allowed_methods=None):
+    def route(self, path, allowed_methods=None, instance="request"):
         def wrapper(handler):
-            self.add_route(path, handler, allowed_methods)
+            self.add_route(path, handler, allowed_methods, instance)
             return handler
         return wrapper
 
-    def template(self, template_name, context=None):
-        if context is None:
-            context = {}
-        return self._templates_env.get_template(template_name).render(**context)
+    def mount(self, prefix, wsgi_app):
+        self._routes.mount(prefix, wsgi_app)
+
+    def template(self, template_name, context=None, cache_key=None, ttl=None):
+        return self.templates.render(template_name, context, cache_key=cache_key, ttl=ttl)
     
     def default_response(self, response):
         response.status_code = 404
         response.text = "Not found"
         
+    def method_not_allowed_response(self, response, route):
+        response.status_code = 405
+        response.text = "Method not allowed"
+        response.headers["Allow"] = route.allow
+        
     def add_exception_handler(self, exception_handler):
         self.exception_handler = exception_handler
         
-    def add_middleware(self, middleware_cls):
-        self.middleware.add(middleware_cls)
\ No newline at end of file
+    def add_middleware(self, middleware_cls, **options):
+        return self.middleware.add(middleware_cls, **options)
+    
+    def enable_metrics(self, path="/metrics", buckets=DEFAULT_BUCKETS):
+        self.metrics = Metrics(buckets)
+        self._instrumented = True
+        if path is not None:
+            self.add_route(path, self._metrics_handler, allowed_methods=["get"])
+        return self.metrics
+    
+    def _metrics_handler(self, req, resp):
+        resp.body = self.metrics.render().encode()
+        resp.content_type = METRICS_CONTENT_TYPE
+    
+    def enable_profiling(self, output_dir, sample_rate=0.0, secret=None, mode="cprofile",
+                         interval=0.001, header=PROFILE_HEADER):
+        self.profiler = Profiler(output_dir, sample_rate=sample_rate, secret=secret, mode=mode,
+                                 interval=interval, header=header)
+        self._instrumented = True
+        return self.profiler
+    
+    def enable_slow_request_log(self, threshold=0.5, logger=None, keep=100):
+        self.slow_request_log = SlowRequestLog(threshold=threshold, logger=logger, keep=keep)
+        self._instrumented = True
+        return self.slow_request_log
\ No newline at end of file
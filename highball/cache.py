@@ -0,0 +1,260 @@
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from .middleware import Middleware
+from .response import Response
+
+CACHEABLE_METHODS = ("GET", "HEAD")
+
+
+# entries live for `ttl` seconds (forever when it's None) and the least
+# recently used ones are dropped once there are more than `max_entries`
+class LRUCache:
+    def __init__(self, max_entries=1024, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires, value = entry
+            if expires is not None and expires < time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_set(self, key, create, ttl=None):
+        value = self.get(key)
+        if value is None:
+            value = create()
+            self.set(key, value, ttl)
+        return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def discard(self, predicate):
+        with self._lock:
+            keys = [key for key, (_, value) in self._entries.items() if predicate(key, value)]
+            for key in keys:
+                del self._entries[key]
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    # drops one key, or everything when no key is given. kept from the
+    # template fragment cache this class replaced
+    def invalidate(self, key=None):
+        if key is None:
+            self.clear()
+        else:
+            self.pop(key)
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+def cached(ttl=None):
+    def wrapper(handler):
+        handler.highball_cache = True if ttl is None else ttl
+        return handler
+    return wrapper
+
+
+def never_cache(handler):
+    handler.highball_cache = False
+    return handler
+
+
+def compute_etag(body):
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+class _CachedResponse:
+    __slots__ = ("route", "status_code", "content_type", "body", "headers", "etag", "last_modified")
+
+    def __init__(self, route, response, etag, last_modified):
+        self.route = route
+        self.status_code = response.status_code
+        self.content_type = response.content_type
+        self.body = response.body
+        self.headers = dict(response.headers)
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def response(self):
+        response = Response()
+        response.status_code = self.status_code
+        response.content_type = self.content_type
+        response.body = self.body
+        response.headers = dict(self.headers)
+        return response
+
+
+# GET responses are kept in an in-memory LRU keyed on method, path, query
+# string and the request headers named by the `vary` option and by the Vary
+# headers of the responses seen for that URL. every buffered 200 response
+# gets an ETag, and If-None-Match / If-Modified-Since are answered with a
+# bodiless 304. with `default=False` only handlers marked with @cached are
+# stored, otherwise everything is except handlers marked with @never_cache.
+# requests carrying a Cookie or Authorization header are only cached for
+# handlers marked with @cached, other routes may answer them per user
+class CacheMiddleware(Middleware):
+    def __init__(self, app, max_entries=1024, ttl=60, vary=(), default=True, max_body_size=1024 * 1024):
+        super().__init__(app)
+        # self.app becomes the next middleware when they are nested, routes
+        # are always resolved by the API itself
+        self.api = app
+        self.cache = LRUCache(max_entries=max_entries, ttl=ttl)
+        self.variants = LRUCache(max_entries=max_entries)
+        self.vary = tuple(name.lower() for name in vary)
+        self.default = default
+        self.max_body_size = max_body_size
+
+    def process_request(self, req):
+        if req.method not in CACHEABLE_METHODS or self._route_ttl(req) is False:
+            return None
+
+        entry = self.cache.get(self._key(req))
+        if entry is None:
+            return None
+
+        response = entry.response()
+        self._answer_conditional(req, response, entry.etag, entry.last_modified)
+        return response
+
+    def process_response(self, req, resp):
+        if req.method not in CACHEABLE_METHODS or resp.status_code != 200 or resp.streaming:
+            return
+        if "ETag" in resp.headers:
+            return
+
+        resp.set_body_and_content_type()
+        if resp.body is None:
+            return
+
+        etag = compute_etag(resp.body)
+        last_modified = int(time.time())
+        resp.headers["ETag"] = etag
+        resp.headers["Last-Modified"] = formatdate(last_modified, usegmt=True)
+
+        ttl = self._route_ttl(req)
+        vary = self._vary_names(resp)
+        if ttl is not False and vary is not None and not resp.cookies and len(resp.body) <= self.max_body_size:
+            route, _ = self.api.resolve(req)
+            # names only ever get added, so requests keep finding every variant
+            base = (req.path, req.query_string)
+            names = tuple(sorted(set(self.variants.get(base, ())) | set(vary)))
+            self.variants.set(base, names)
+            self.cache.set(
+                self._key(req),
+                _CachedResponse(route.path if route else None, resp, etag, last_modified),
+                ttl=None if ttl is True else ttl,
+            )
+
+        self._answer_conditional(req, resp, etag, last_modified)
+
+    def invalidate(self, path=None, prefix=None, route=None):
+        if path is None and prefix is None and route is None:
+            count = len(self.cache)
+            self.cache.clear()
+            return count
+
+        def matches(key, entry):
+            return (
+                (path is not None and key[1] == path)
+                or (prefix is not None and key[1].startswith(prefix))
+                or (route is not None and entry.route == route)
+            )
+        return self.cache.discard(matches)
+
+    def _key(self, req):
+        names = self.variants.get((req.path, req.query_string), ())
+        return (
+            "GET",
+            req.path,
+            req.query_string,
+            tuple(req.headers.get(name) for name in self.vary + names),
+        )
+
+    # the request headers a response varies on, None for "Vary: *"
+    def _vary_names(self, resp):
+        vary = resp.headers.get("Vary")
+        if not vary:
+            return ()
+        names = [name.strip().lower() for name in vary.split(",") if name.strip()]
+        if "*" in names:
+            return None
+        return tuple(name for name in names if name not in self.vary)
+
+    # True/a number of seconds when the route should be cached, False when not
+    def _route_ttl(self, req):
+        route, _ = self.api.resolve(req)
+        if route is None:
+            return False
+        ttl = getattr(route.handler, "highball_cache", None)
+        if ttl is None:
+            if "Cookie" in req.headers or "Authorization" in req.headers:
+                return False
+            return self.default
+        return ttl
+
+    def _answer_conditional(self, req, resp, etag, last_modified):
+        if_none_match = req.headers.get("If-None-Match")
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(",")]
+            if etag in tags or "*" in tags:
+                self._not_modified(resp)
+            return
+
+        if_modified_since = req.headers.get("If-Modified-Since")
+        if if_modified_since is not None:
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return
+            if last_modified <= since:
+                self._not_modified(resp)
+
+    def _not_modified(self, resp):
+        resp.status_code = 304
+        resp.body = None
+        resp.json = resp.html = resp.text = None
@@ -0,0 +1,108 @@
+import zlib
+import hashlib
+from .cache import LRUCache
+from .middleware import Middleware
+
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+SKIPPED_CONTENT_TYPES = (
+    "image/",
+    "video/",
+    "audio/",
+    "font/woff",
+    "application/zip",
+    "application/gzip",
+    "application/x-gzip",
+    "application/octet-stream",
+    "application/pdf",
+)
+
+
+def accepts_gzip(accept_encoding):
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().lower() not in ("gzip", "*"):
+            continue
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                return float(params[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+
+def gzip_compress(body, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+def gzip_stream(stream, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    try:
+        for chunk in stream:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("UTF-8")
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+    finally:
+        if hasattr(stream, "close"):
+            stream.close()
+
+
+# gzips responses for clients that accept it. buffered bodies below
+# `min_size` are left alone and compressed bodies are kept in a small LRU
+# keyed on the body hash, streams are compressed chunk by chunk as they go
+# out. `levels` maps a content type (or a prefix like "text/") to a level
+class CompressionMiddleware(Middleware):
+    def __init__(self, app, min_size=500, level=6, levels=None, skip=SKIPPED_CONTENT_TYPES,
+                 cache_entries=256):
+        super().__init__(app)
+        self.min_size = min_size
+        self.level = level
+        self.levels = dict(levels or {})
+        self.skip = tuple(skip)
+        self.cache = LRUCache(max_entries=cache_entries)
+
+    def process_response(self, req, resp):
+        if resp.file is not None or resp.status_code < 200 or resp.status_code in (204, 304):
+            return
+        if "Content-Encoding" in resp.headers:
+            return
+        if not accepts_gzip(req.headers.get("Accept-Encoding", "")):
+            return
+
+        if resp.stream is None:
+            resp.set_body_and_content_type()
+        content_type = (resp.content_type or "").split(";", 1)[0].strip().lower()
+        if content_type.startswith(self.skip):
+            return
+        level = self._level(content_type)
+
+        if resp.stream is not None:
+            resp.stream = gzip_stream(resp.stream, level)
+        else:
+            body = resp.body
+            if body is None or len(body) < self.min_size:
+                return
+            key = (hashlib.blake2b(body, digest_size=16).digest(), level)
+            resp.replace_body(self.cache.get_or_set(key, lambda: gzip_compress(body, level)))
+
+        resp.headers["Content-Encoding"] = "gzip"
+        vary = resp.headers.get("Vary")
+        if vary is None:
+            resp.headers["Vary"] = "Accept-Encoding"
+        elif "accept-encoding" not in vary.lower():
+            resp.headers["Vary"] = vary + ", Accept-Encoding"
+
+    def _level(self, content_type):
+        level = self.levels.get(content_type)
+        if level is not None:
+            return level
+        for prefix, level in self.levels.items():
+            if prefix.endswith("/") and content_type.startswith(prefix):
+                return level
+        return self.level
@@ -0,0 +1,106 @@
+import threading
+from bisect import bisect_left
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+UNMATCHED_ROUTE = "<unmatched>"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, size):
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class _RouteSeries:
+    __slots__ = ("requests", "histograms")
+
+    def __init__(self):
+        self.requests = {}
+        self.histograms = {}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(**labels):
+    return ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items())
+
+
+# everything is recorded under one lock with a handful of dict updates, which
+# keeps it in the low microseconds and safe for threaded workers. latencies
+# go into fixed buckets so recording never allocates per observation
+class Metrics:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.exceptions = {}
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe_request(self, route, method, status, timings):
+        buckets = self.buckets
+        with self._lock:
+            series = self._series.get(route)
+            if series is None:
+                series = self._series[route] = _RouteSeries()
+            key = (method, status)
+            series.requests[key] = series.requests.get(key, 0) + 1
+            histograms = series.histograms
+            for phase, seconds in timings.items():
+                histogram = histograms.get(phase)
+                if histogram is None:
+                    histogram = histograms[phase] = Histogram(len(buckets) + 1)
+                histogram.counts[bisect_left(buckets, seconds)] += 1
+                histogram.sum += seconds
+                histogram.count += 1
+
+    def observe_exception(self, route, exception):
+        key = (route, type(exception).__name__)
+        with self._lock:
+            self.exceptions[key] = self.exceptions.get(key, 0) + 1
+
+    def render(self):
+        with self._lock:
+            requests = sorted(
+                ((route, method, status), count)
+                for route, series in self._series.items()
+                for (method, status), count in series.requests.items()
+            )
+            exceptions = sorted(self.exceptions.items())
+            histograms = sorted(
+                ((route, phase), list(histogram.counts), histogram.sum, histogram.count)
+                for route, series in self._series.items()
+                for phase, histogram in series.histograms.items()
+            )
+
+        lines = [
+            "# HELP highball_requests_total Requests by route pattern, method and status code.",
+            "# TYPE highball_requests_total counter",
+        ]
+        for (route, method, status), count in requests:
+            labels = _format_labels(route=route, method=method, status=status)
+            lines.append(f"highball_requests_total{{{labels}}} {count}")
+
+        lines.append("# HELP highball_exceptions_total Exceptions raised by handlers by type.")
+        lines.append("# TYPE highball_exceptions_total counter")
+        for (route, exception), count in exceptions:
+            labels = _format_labels(route=route, exception=exception)
+            lines.append(f"highball_exceptions_total{{{labels}}} {count}")
+
+        lines.append("# HELP highball_request_duration_seconds Request latency by route pattern and phase.")
+        lines.append("# TYPE highball_request_duration_seconds histogram")
+        for (route, phase), counts, total, count in histograms:
+            labels = _format_labels(route=route, phase=phase)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'highball_request_duration_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f"highball_request_duration_seconds_sum{{{labels}}} {total}")
+            lines.append(f"highball_request_duration_seconds_count{{{labels}}} {count}")
+
+        return "\n".join(lines) + "\n"
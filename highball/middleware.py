@@ -1,26 +1,120 @@
-from webob import Request
+import inspect
+from .request import Request
 
 class Middleware:
     def __init__(self, app):
         self.app = app
-    
+
     def __call__(self, environ, start_response):
         request = Request(environ=environ)
-        response = self.app.handle_request(request)
+        response = self.handle_request(request)
         return response(environ, start_response)
-    
-    def add(self, middleware_cls):
-        self.app = middleware_cls(self.app)
-        
+
     def handle_request(self, request):
-        self.process_request(req=request)
-        response = self.app.handle_request(request)
+        response = self.process_request(req=request)
+        if response is None:
+            response = self.app.handle_request(request)
         self.process_response(req=request, resp=response)
-        
+
         return response
-        
+
     def process_request(self, req):
         pass
-    
+
     def process_response(self, req, resp):
-        pass
\ No newline at end of file
+        pass
+
+
+def _overrides(middleware, hook):
+    return getattr(type(middleware), hook) is not getattr(Middleware, hook)
+
+
+# the registered middleware compiled into two flat lists of hooks instead of
+# nested handle_request calls. the last added middleware is the outermost one,
+# exactly like when they were wrapped around each other, and hooks that were
+# left at the Middleware no-op are never called. a middleware that overrides
+# handle_request itself needs the one it wraps, so then they are all wrapped
+# around each other again and called the nested way
+class Pipeline:
+    def __init__(self, app):
+        self.app = app
+        self.middleware = []
+        self._hooks = None
+        self._nested = None
+
+    def add(self, middleware_cls, **options):
+        middleware = middleware_cls(self.app, **options)
+        self.middleware.append(middleware)
+        self._hooks = None
+        return middleware
+
+    def compile(self):
+        self._nested = None
+        if any(_overrides(middleware, "handle_request") for middleware in self.middleware):
+            inner = self.app
+            for middleware in self.middleware:
+                middleware.app = inner
+                inner = middleware
+            self._nested = inner
+
+        outermost_first = list(reversed(self.middleware))
+        request_hooks = tuple(
+            (depth, middleware.process_request)
+            for depth, middleware in enumerate(outermost_first)
+            if _overrides(middleware, "process_request")
+        )
+        response_hooks = tuple(
+            (depth, middleware.process_response)
+            for depth, middleware in reversed(list(enumerate(outermost_first)))
+            if _overrides(middleware, "process_response")
+        )
+        self._hooks = (request_hooks, response_hooks)
+        return self._hooks
+
+    # a process_request that returns a response stops the request there, only
+    # that middleware and the ones around it get to see the response
+    def handle_request(self, request):
+        request_hooks, response_hooks = self._hooks or self.compile()
+        if self._nested is not None:
+            return self._nested.handle_request(request)
+
+        response, reached = None, len(self.middleware)
+        for depth, process_request in request_hooks:
+            response = process_request(req=request)
+            if response is not None:
+                reached = depth
+                break
+        else:
+            response = self.app.handle_request(request)
+
+        for depth, process_response in response_hooks:
+            if depth <= reached:
+                process_response(req=request, resp=response)
+
+        return response
+
+    async def handle_request_async(self, request):
+        request_hooks, response_hooks = self._hooks or self.compile()
+        if self._nested is not None:
+            if request.trace is None:
+                return await self.app.run_in_thread(self._nested.handle_request, request)
+            return await self.app.run_in_thread(request.trace.run, self._nested.handle_request, request)
+
+        response, reached = None, len(self.middleware)
+        for depth, process_request in request_hooks:
+            response = process_request(req=request)
+            if inspect.isawaitable(response):
+                response = await response
+            if response is not None:
+                reached = depth
+                break
+        else:
+            response = await self.app.handle_request_async(request)
+
+        for depth, process_response in response_hooks:
+            if depth <= reached:
+                result = process_response(req=request, resp=response)
+                if inspect.isawaitable(result):
+                    await result
+
+        return response
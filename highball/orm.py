@@ -1,204 +1,1081 @@
+import io
+import csv
+import json
+import asyncio
 import inspect
 import sqlite3
+import itertools
+import warnings
+import threading
+import contextlib
+import functools
+import contextvars
+from collections import namedtuple
+from time import monotonic
+from .cache import LRUCache
+from .middleware import Middleware
 
+# a list to append every SQL statement to, set for the length of a request
+# by the slow request log
+query_log = contextvars.ContextVar("highball_query_log", default=None)
+
+# the connections bound to the current request or `with db.connection()`
+# block, as an immutable {database: lease} mapping
+_connections = contextvars.ContextVar("highball_connections", default=None)
+
+# the identity maps of open `with db.session()` blocks, {database: {(table, id): row}}
+_sessions = contextvars.ContextVar("highball_sessions", default=None)
+
+RELATED_MODES = ("join", "prefetch", "lazy")
+ITER_MODES = ("instances", "tuples", "namedtuples")
+GENERATIONS_TABLE = "highball_generations"
+# ids per WHERE id IN (...) query, well under SQLite's variable limit
+IN_CHUNK_SIZE = 500
+
+DEFAULT_PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "busy_timeout": 5000,
+}
+
+
+def _trace_statement(statement):
+    queries = query_log.get()
+    if queries is not None:
+        queries.append(statement)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class FullScanWarning(UserWarning):
+    pass
+
+
+# remembers how many db.transaction() blocks are open on it, and which
+# cached results to drop once the outermost one is over
+class Connection(sqlite3.Connection):
+    transaction_depth = 0
+    invalidations = ()
+
+
+# hands out up to `max_size` connections, newest idle one first, and blocks
+# for `timeout` seconds when all of them are checked out. every connection
+# gets the `pragmas` when it is opened. an in-memory database only exists
+# inside the connection that created it, so it is one connection shared by
+# every caller instead
+class ConnectionPool:
+    def __init__(self, path, max_size=5, timeout=5.0, pragmas=None):
+        self.path = path
+        self.memory = path == ":memory:" or "mode=memory" in path
+        self.max_size = 1 if self.memory else max_size
+        self.timeout = timeout
+        self.pragmas = {**DEFAULT_PRAGMAS, **(pragmas or {})}
+        self.size = 0
+        self._idle = []
+        self._shared = None
+        self._condition = threading.Condition()
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+    def connect(self):
+        conn = sqlite3.connect(
+            self.path, check_same_thread=False, uri=self.path.startswith("file:"), factory=Connection
+        )
+        for name, value in self.pragmas.items():
+            if value is None or (self.memory and name == "journal_mode"):
+                continue
+            conn.execute(f"PRAGMA {name} = {value}")
+        conn.set_trace_callback(_trace_statement)
+        return conn
+
+    def acquire(self, timeout=None):
+        if self.memory:
+            with self._condition:
+                if self._shared is None:
+                    self._shared = self.connect()
+                    self.size = 1
+                return self._shared
+
+        deadline = monotonic() + (self.timeout if timeout is None else timeout)
+        with self._condition:
+            while not self._idle and self.size >= self.max_size:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout(
+                        f"No connection to {self.path} available after {self.timeout if timeout is None else timeout}s"
+                    )
+                self._condition.wait(remaining)
+            if self._idle:
+                return self._idle.pop()
+            self.size += 1
+
+        try:
+            return self.connect()
+        except Exception:
+            with self._condition:
+                self.size -= 1
+                self._condition.notify()
+            raise
+
+    def release(self, conn):
+        if self.memory:
+            return
+        if conn.in_transaction:
+            conn.rollback()
+        conn.transaction_depth = 0
+        with self._condition:
+            self._idle.append(conn)
+            self._condition.notify()
+
+    def close(self):
+        with self._condition:
+            conns, self._idle = self._idle, []
+            if self._shared is not None:
+                conns.append(self._shared)
+                self._shared = None
+            self.size -= len(conns)
+        for conn in conns:
+            conn.close()
+
+
+# read-through cache of the rows behind db.get() (keyed by table and id) and
+# Query.all() (keyed by the statement), see Database.enable_cache. entries
+# remember every table their rows came from and a write to one of those
+# tables drops them: by id for get() of the same table, all of them
+# otherwise. invalidating also bumps the table's version, and rows read while
+# the version of one of their tables changed are not stored, they may be from
+# before the write. with `shared` every write also bumps a per-table counter
+# in a sqlite table, and each process drops what other processes changed
+# when it notices, at most `check_interval` seconds later
+class ResultCache:
+    def __init__(self, db, max_entries=1024, ttl=60, shared=False, check_interval=1.0):
+        self.db = db
+        self.entries = LRUCache(max_entries=max_entries, ttl=ttl)
+        self.shared = shared
+        self.check_interval = check_interval
+        self.generations = {}
+        self.versions = {}
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        if shared:
+            with db._leased() as conn:
+                conn.execute(
+                    f"CREATE TABLE IF NOT EXISTS {GENERATIONS_TABLE} (name TEXT PRIMARY KEY, generation INTEGER NOT NULL);"
+                )
+                conn.commit()
+                self.sync(force=True)
+
+    def get(self, key):
+        if self.shared:
+            self.sync()
+        return self.entries.get(key)
+
+    def version(self, tables):
+        return tuple(self.versions.get(name, 0) for name in tables)
+
+    # stores the rows unless one of their tables changed since `version`
+    def set(self, key, rows, version=None):
+        with self._lock:
+            if version is not None and version != self.version(key[0]):
+                return False
+            self.entries.set(key, rows)
+        return True
+
+    def invalidate(self, name, id=None):
+        with self._lock:
+            self.versions[name] = self.versions.get(name, 0) + 1
+
+        def stale(key, _):
+            tables, kind, primary = key[:3]
+            if name not in tables:
+                return False
+            return id is None or kind != "get" or primary != name or key[3] == id
+        return self.entries.discard(stale)
+
+    def bump(self, conn, name):
+        conn.execute(
+            f"INSERT INTO {GENERATIONS_TABLE} (name, generation) VALUES (?, 1) "
+            "ON CONFLICT (name) DO UPDATE SET generation = generation + 1;",
+            [name],
+        )
+
+    def sync(self, force=False):
+        now = monotonic()
+        with self._lock:
+            if not force and now - self._checked < self.check_interval:
+                return
+            self._checked = now
+        rows = self.db.conn.execute(f"SELECT name, generation FROM {GENERATIONS_TABLE};").fetchall()
+        for name, generation in rows:
+            if self.generations.get(name) != generation:
+                self.generations[name] = generation
+                if not force:
+                    self.invalidate(name)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return self.entries.stats()
+
+
+# a checked out connection that goes back to the pool when released, or as a
+# last resort when nothing refers to it anymore
+class _Lease:
+    __slots__ = ("pool", "conn")
+
+    def __init__(self, pool, timeout=None):
+        self.pool = pool
+        self.conn = None
+        self.conn = pool.acquire(timeout)
+
+    def release(self):
+        conn, self.conn = self.conn, None
+        if conn is not None:
+            self.pool.release(conn)
+
+    def __del__(self):
+        self.release()
+
+
+# one SELECT with a LEFT JOIN per foreign key, all the way down, plus where
+# each table's columns start in the joined row. built once per table
+def _join_query(table):
+    schema = table._schema
+    if schema.join_query is not None:
+        return schema.join_query
+
+    columns, joins = [], []
+
+    def visit(table, alias):
+        start = len(columns)
+        columns.extend(f"{alias}.{field}" for field in table._schema.fields)
+        children = []
+        for index, _, fk_table, set_value in table._schema.foreign_keys:
+            child = f"t{len(joins) + 1}"
+            joins.append(
+                f"LEFT JOIN {fk_table._schema.name} AS {child} ON {child}.id = {alias}.{table._schema.fields[index]}"
+            )
+            children.append((set_value, visit(fk_table, child)))
+        return table, start, children
+
+    plan = visit(table, "t0")
+    sql = " ".join([f"SELECT {', '.join(columns)} FROM {schema.name} AS t0"] + joins)
+    schema.join_query = (sql, plan)
+    return schema.join_query
+
+
+def _bind(db, lease):
+    return _connections.set({**(_connections.get() or {}), db: lease})
+
+
+# runs a Database method on the bound connection, or on one checked out of
+# the pool for just this call when none is bound
+def _connected(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._leased():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+# every operation uses the connection bound to the current request or `with
+# db.connection()` block, or checks one out for as long as it runs, so idle
+# threads never hold on to one. `db.conn` used directly outside of those is
+# one the calling thread keeps until db.release(). either way no two threads
+# ever use the same connection
 class Database:
-    def __init__(self, path):
-        self.conn = sqlite3.Connection(path)
+    def __init__(self, path, pool_size=5, timeout=5.0, pragmas=None, check_plans=False):
+        self.pool = ConnectionPool(path, max_size=pool_size, timeout=timeout, pragmas=pragmas)
+        self.check_plans = check_plans
+        self.cache = None
+        self._local = threading.local()
+        self._explained = set()
+
+    @property
+    def conn(self):
+        lease = self._bound()
+        if lease is None:
+            lease = getattr(self._local, "lease", None)
+            if lease is None or lease.conn is None:
+                lease = self._local.lease = _Lease(self.pool)
+        return lease.conn
+
+    def _bound(self):
+        bound = _connections.get()
+        lease = bound.get(self) if bound else None
+        return None if lease is None or lease.conn is None else lease
+
+    @contextlib.contextmanager
+    def connection(self):
+        lease = _Lease(self.pool)
+        try:
+            with self._binding(lease) as conn:
+                yield conn
+        finally:
+            lease.release()
+
+    @contextlib.contextmanager
+    def _binding(self, lease):
+        token = _bind(self, lease)
+        try:
+            yield lease.conn
+        finally:
+            _connections.reset(token)
+
+    # the bound connection, or the one the calling thread already holds, or a
+    # new one bound for the length of the block
+    @contextlib.contextmanager
+    def _leased(self):
+        lease = self._bound() or getattr(self._local, "lease", None)
+        if lease is not None and lease.conn is not None:
+            yield lease.conn
+        else:
+            with self.connection() as conn:
+                yield conn
+
+    # commits once when the outermost block exits and rolls back if it raises.
+    # nested blocks become savepoints, so an inner failure that is caught only
+    # undoes the inner block. save, update and delete don't commit inside a
+    # transaction. works as a decorator too: @db.transaction()
+    @contextlib.contextmanager
+    def transaction(self, immediate=False):
+        with self._leased() as conn:
+            depth = conn.transaction_depth
+            if depth:
+                savepoint = f"highball_{depth}"
+                conn.execute(f"SAVEPOINT {savepoint}")
+            elif not conn.in_transaction:
+                conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+
+            if not depth:
+                conn.invalidations = []
+            conn.transaction_depth = depth + 1
+            try:
+                yield conn
+            except BaseException:
+                if depth:
+                    conn.execute(f"ROLLBACK TO SAVEPOINT {savepoint}")
+                    conn.execute(f"RELEASE SAVEPOINT {savepoint}")
+                else:
+                    conn.rollback()
+                raise
+            else:
+                if depth:
+                    conn.execute(f"RELEASE SAVEPOINT {savepoint}")
+                else:
+                    conn.commit()
+            finally:
+                conn.transaction_depth = depth
+                if not depth:
+                    invalidations, conn.invalidations = conn.invalidations, ()
+                    if self.cache is not None:
+                        for table, id in invalidations:
+                            self.cache.invalidate(table._schema.name, id)
+
+    # commits a write to `table` unless a transaction is open and drops the
+    # cached results it made stale once it is committed. a read that ran
+    # before the commit and finishes after it doesn't store its rows, the
+    # invalidation bumped the table's version in between
+    def _commit(self, conn, table, id=None):
+        cache = self.cache
+        if cache is not None and cache.shared:
+            cache.bump(conn, table._schema.name)
+        if conn.transaction_depth:
+            if cache is not None:
+                conn.invalidations.append((table, id))
+            return
+        conn.commit()
+        if cache is not None:
+            cache.invalidate(table._schema.name, id)
+
+    def enable_cache(self, max_entries=1024, ttl=60, shared=False, check_interval=1.0):
+        self.cache = ResultCache(self, max_entries=max_entries, ttl=ttl, shared=shared, check_interval=check_interval)
+        return self.cache
+
+    def _cached_rows(self, key, sql, params, fetch_one=False):
+        cache = self.cache
+        # a transaction that wrote something reads its own uncommitted rows,
+        # which must neither come from nor go into the cache
+        if cache is not None and self.conn.invalidations:
+            cache = None
+        rows = None if cache is None else cache.get(key)
+        if rows is None:
+            version = None if cache is None else cache.version(key[0])
+            cursor = self._execute(sql, params)
+            rows = cursor.fetchmany(1) if fetch_one else cursor.fetchall()
+            # a get() for a missing id isn't cached, the row may be saved next
+            if cache is not None and (rows or not fetch_one):
+                cache.set(key, rows, version)
+        return rows
+
+    def release(self):
+        lease = getattr(self._local, "lease", None)
+        if lease is not None:
+            lease.release()
+            self._local.lease = None
+
+    def close(self):
+        self.release()
+        self.pool.close()
     
     @property
+    @_connected
     def tables(self):
         SELECT_TABLES_SQL = "SELECT name FROM sqlite_master WHERE type = 'table'"
         return [x[0] for x in self.conn.execute(SELECT_TABLES_SQL).fetchall()]
     
+    @_connected
     def create(self, table):
-        self.conn.execute(table._get_create_sql())
+        conn = self.conn
+        conn.execute(table._get_create_sql())
+        for sql in table._get_index_sql():
+            conn.execute(sql)
+
+    # runs EXPLAIN QUERY PLAN and warns when a filtered query reads the whole
+    # table or an ordered one has to sort in a temporary b-tree, which usually
+    # means an index is missing. a plain scan in primary key order, like
+    # order_by("-id").limit(n), is fine. with
+    # check_plans=True every statement a Query builds goes through it once,
+    # so running the test suite with -W error::highball.orm.FullScanWarning
+    # catches them in CI
+    @_connected
+    def explain(self, sql, params=()):
+        plan = [row[3] for row in self.conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+        scans = [detail for detail in plan if detail.startswith("SCAN") and "INDEX" not in detail]
+        sorts = [detail for detail in plan if detail.startswith("USE TEMP B-TREE")]
+        if sorts or (scans and " WHERE " in sql):
+            details = "; ".join(scans + sorts)
+            warnings.warn(f"Query plan without an index ({details}) for: {sql}", FullScanWarning, stacklevel=2)
+        return plan
+
+    def _execute(self, sql, params=()):
+        if self.check_plans and sql not in self._explained:
+            self._explained.add(sql)
+            self.explain(sql, params)
+        return self.conn.execute(sql, params)
     
+    @_connected
     def save(self, instance):
         sql, values = instance._get_insert_sql()
-        cursor = self.conn.execute(sql, values)
-        instance._data["id"] =  cursor.lastrowid
-        self.conn.commit()
+        conn = self.conn
+        cursor = conn.execute(sql, values)
+        instance.id = cursor.lastrowid
+        self._commit(conn, type(instance), instance.id)
+
+    # inserts `chunk_size` rows at a time with one executemany per table and
+    # one transaction per chunk. AUTOINCREMENT ids are consecutive while the chunk
+    # holds the write lock, so they are assigned back from last_insert_rowid().
+    # `instances` can be a generator, it is only read a chunk at a time
+    @_connected
+    def save_many(self, instances, chunk_size=1000):
+        conn = self.conn
+        iterator = iter(instances)
+        saved = 0
+        while True:
+            chunk = list(itertools.islice(iterator, chunk_size))
+            if not chunk:
+                return saved
+
+            groups = {}
+            for instance in chunk:
+                sql, values = instance._get_insert_sql()
+                group = groups.get(sql)
+                if group is None:
+                    group = groups[sql] = ([], [])
+                group[0].append(instance)
+                group[1].append(values)
+
+            ids = []
+            with self.transaction():
+                for sql, (group, rows) in groups.items():
+                    conn.executemany(sql, rows)
+                    last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+                    ids.append((group, range(last_id - len(group) + 1, last_id + 1)))
+                    self._commit(conn, type(group[0]))
+
+            for group, group_ids in ids:
+                for instance, id in zip(group, group_ids):
+                    instance.id = id
+            saved += len(chunk)
     
-    def all(self, table):
-        sql, fields = table._get_select_all_sql()
-        result = []
-        for row in self.conn.execute(sql).fetchall():
-            instance = table()
-            for field, value in zip(fields, row):
-                if field.endswith("_id"):
-                    field = field[:-3]
-                    fk = getattr(table, field)
-                    value = self.get(fk.table, id=value)
-                setattr(instance, field, value)
-            result.append(instance)
-        return result
+    # how foreign keys are loaded: "join" fetches the whole tree in one query
+    # with LEFT JOINs, "prefetch" with one WHERE id IN (...) query per foreign
+    # key and "lazy" only when the attribute is first used. rows are
+    # materialized once per (table, id) for the call, or for the whole
+    # `with db.session()` block
+    def all(self, table, related="prefetch"):
+        return Query(self, table).all(related=related)
+
+    def query(self, table):
+        return Query(self, table)
+
+    def iter(self, table, chunk_size=1000, mode="instances"):
+        return Query(self, table).iter(chunk_size=chunk_size, mode=mode)
     
-    def get(self, table, id):
-        sql, fields, params = table._get_select_where_sql(id=id)
-        
-        row = self.conn.execute(sql, params).fetchone()
-        if row is None:
+    @_connected
+    def get(self, table, id, related="join"):
+        assert related in RELATED_MODES, f"Unknown related loading mode '{related}'"
+        instance = self._get(table, id, related, self._identity_map())
+        if instance is None:
             raise Exception(f"{table.__name__} instance with id {id} does not exist")
-    
-        instance = table()
-        for field, value in zip(fields, row):
-            if field.endswith("_id"):
-                field = field[:-3]
-                fk = getattr(table, field)
-                value = self.get(fk.table, id=value)
-            setattr(instance, field, value)
-        
         return instance
+
+    @contextlib.contextmanager
+    def session(self):
+        identity_map = {}
+        token = _sessions.set({**(_sessions.get() or {}), self: identity_map})
+        try:
+            yield identity_map
+        finally:
+            _sessions.reset(token)
+
+    def _identity_map(self):
+        sessions = _sessions.get()
+        identity_map = sessions.get(self) if sessions else None
+        return {} if identity_map is None else identity_map
+
+    def _forget(self, table, id):
+        sessions = _sessions.get()
+        identity_map = sessions.get(self) if sessions else None
+        if identity_map is not None:
+            identity_map.pop((table, id), None)
+
+    def _get(self, table, id, related, identity_map):
+        instance = identity_map.get((table, id))
+        if instance is not None:
+            return instance
+
+        schema = table._schema
+        if related == "join":
+            sql, plan = _join_query(table)
+            key = (schema.related_tables, "get", schema.name, id, related)
+            rows = self._cached_rows(key, sql + " WHERE t0.id = ?;", [id], fetch_one=True)
+            return self._from_join(plan, rows[0], identity_map) if rows else None
+
+        key = (frozenset((schema.name,)), "get", schema.name, id, related)
+        rows = self._cached_rows(key, schema.select_where_sql, [id], fetch_one=True)
+        return self._hydrate(table, rows, identity_map, related)[0] if rows else None
+
+    def _from_join(self, plan, row, identity_map):
+        table, start, children = plan
+        id = row[start]
+        if id is None:
+            return None
+        instance = identity_map.get((table, id))
+        if instance is None:
+            instance = identity_map[(table, id)] = table.__new__(table)
+            instance.id = id
+            for index, _, set_value in table._schema.columns:
+                set_value(instance, row[start + index])
+            for set_value, child in children:
+                set_value(instance, self._from_join(child, row, identity_map))
+        return instance
+
+    def _hydrate(self, table, rows, identity_map, related):
+        columns = table._schema.columns
+        result, fresh = [], []
+        for row in rows:
+            instance = identity_map.get((table, row[0]))
+            if instance is None:
+                instance = identity_map[(table, row[0])] = table.__new__(table)
+                instance.id = row[0]
+                for index, _, set_value in columns:
+                    set_value(instance, row[index])
+                fresh.append((instance, row))
+            result.append(instance)
+
+        for index, _, fk_table, set_value in table._schema.foreign_keys:
+            if related == "lazy":
+                for instance, row in fresh:
+                    value = row[index]
+                    if value is not None:
+                        value = identity_map.get((fk_table, value)) or LazyForeignKey(self, fk_table, value, identity_map)
+                    set_value(instance, value)
+                continue
+
+            missing = {
+                row[index] for _, row in fresh
+                if row[index] is not None and (fk_table, row[index]) not in identity_map
+            }
+            if missing:
+                self._prefetch(fk_table, missing, identity_map)
+            for instance, row in fresh:
+                set_value(instance, identity_map.get((fk_table, row[index])))
+
+        return result
+
+    def _prefetch(self, table, ids, identity_map):
+        sql = table._schema.select_sql
+        ids = sorted(ids)
+        rows = []
+        for i in range(0, len(ids), IN_CHUNK_SIZE):
+            chunk = ids[i:i + IN_CHUNK_SIZE]
+            placeholders = ", ".join("?" * len(chunk))
+            rows.extend(self.conn.execute(f"{sql} WHERE id IN ({placeholders});", chunk))
+        self._hydrate(table, rows, identity_map, "prefetch")
     
+    @_connected
     def update(self, instance):
+        self._forget(type(instance), instance.id)
         sql, values = instance._get_update_sql()
-        self.conn.execute(sql, values)
-        self.conn.commit()
+        conn = self.conn
+        conn.execute(sql, values)
+        self._commit(conn, type(instance), instance.id)
         
+    @_connected
     def delete(self, table, id):
+        self._forget(table, id)
         sql, params = table._get_delete_sql(id)
-        self.conn.execute(sql, params)
-        self.conn.commit()
-    
-class Table:
-    def __init__(self, **kwargs):
-        self._data = {
-            "id": None
-        }
-        
-        for key, value in kwargs.items():
-            self._data[key] = value
-    
-    def __getattribute__(self, key):
-        _data = super().__getattribute__("_data")
-        if key in _data:
-            return _data[key]
-        return super().__getattribute__(key)
+        conn = self.conn
+        conn.execute(sql, params)
+        self._commit(conn, table, id)
+
+
+LOOKUPS = {
+    "exact": "=",
+    "ne": "!=",
+    "gt": ">",
+    "gte": ">=",
+    "lt": "<",
+    "lte": "<=",
+    "like": "LIKE",
+    "in": "IN",
+    "isnull": "IS NULL",
+}
+
+
+def _sql_value(value):
+    return value.id if isinstance(value, (Table, LazyForeignKey)) else value
+
+
+# a SELECT built up one call at a time, e.g.
+#   db.query(Book).filter(published=True, id__gt=10).order_by("-id").limit(50)
+# every call returns a new Query so a base query can be reused, and nothing
+# runs until the rows, count() or exists() are asked for. filters are
+# "<field>__<lookup>" with a lookup from LOOKUPS, "exact" when it's left out
+class Query:
+    def __init__(self, db, table):
+        self.db = db
+        self.table = table
+        self._where = ()
+        self._order = ()
+        self._after = None
+        self._limit = None
+        self._offset = None
+
+    def _clone(self, **changes):
+        query = Query.__new__(Query)
+        query.__dict__.update(self.__dict__, **changes)
+        return query
+
+    def _column(self, name):
+        column = self.table._schema.column_names.get(name)
+        assert column is not None, f"{self.table.__name__} has no field '{name}'"
+        return column
+
+    def filter(self, **lookups):
+        where = list(self._where)
+        for key, value in lookups.items():
+            name, _, lookup = key.partition("__")
+            lookup = lookup or "exact"
+            assert lookup in LOOKUPS, f"Unknown lookup '{lookup}'"
+            where.append((self._column(name), lookup, value))
+        return self._clone(_where=tuple(where))
+
+    def order_by(self, *fields):
+        order = tuple(
+            (self._column(field[1:]), "DESC") if field.startswith("-") else (self._column(field), "ASC")
+            for field in fields
+        )
+        return self._clone(_order=order)
+
+    def limit(self, limit):
+        return self._clone(_limit=limit)
+
+    def offset(self, offset):
+        return self._clone(_offset=offset)
+
+    # keyset pagination: the rows that come after `row` in this query's order,
+    # which stays fast on deep pages where OFFSET has to skip every row first.
+    # every order gets id as a tie breaker when it isn't there already, so the
+    # first page and the ones after it sort rows with equal values the same way
+    def after(self, row):
+        return self._clone(_after=row)
+
+    def _ordering(self):
+        order = self._order
+        if (order or self._after is not None) and not any(column == "id" for column, _ in order):
+            order += (("id", order[-1][1] if order else "ASC"),)
+        return order
+
+    def _compile(self, prefix="", ordered=True):
+        where, params = [], []
+        for column, lookup, value in self._where:
+            column = prefix + column
+            if lookup == "isnull" or (value is None and lookup in ("exact", "ne")):
+                negate = not value if lookup == "isnull" else lookup == "ne"
+                where.append(f"{column} IS {'NOT ' if negate else ''}NULL")
+            elif lookup == "in":
+                values = [_sql_value(item) for item in value]
+                where.append(f"{column} IN ({', '.join('?' * len(values))})" if values else "0")
+                params.extend(values)
+            else:
+                where.append(f"{column} {LOOKUPS[lookup]} ?")
+                params.append(_sql_value(value))
+
+        order = self._ordering()
+        if self._after is not None:
+            values = [_sql_value(getattr(self._after, self.table._schema.attribute_names[column])) for column, _ in order]
+            seek = []
+            for i, (column, direction) in enumerate(order):
+                terms = [f"{prefix}{previous} = ?" for previous, _ in order[:i]]
+                terms.append(f"{prefix}{column} {'<' if direction == 'DESC' else '>'} ?")
+                seek.append("(" + " AND ".join(terms) + ")")
+                params.extend(values[:i + 1])
+            where.append("(" + " OR ".join(seek) + ")")
+
+        sql = ""
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        if order and ordered:
+            sql += " ORDER BY " + ", ".join(f"{prefix}{column} {direction}" for column, direction in order)
+        if self._limit is not None or self._offset is not None:
+            sql += " LIMIT ?"
+            params.append(-1 if self._limit is None else self._limit)
+            if self._offset is not None:
+                sql += " OFFSET ?"
+                params.append(self._offset)
+        return sql, params
+
+    def all(self, related="prefetch"):
+        assert related in RELATED_MODES, f"Unknown related loading mode '{related}'"
+        identity_map = self.db._identity_map()
+        schema = self.table._schema
+        sql, params = self._select(related)
+        tables = schema.related_tables if related == "join" else frozenset((schema.name,))
+        with self.db._leased():
+            rows = self.db._cached_rows((tables, "query", schema.name, sql, tuple(params)), sql, params)
+            if related == "join":
+                plan = _join_query(self.table)[1]
+                return [self.db._from_join(plan, row, identity_map) for row in rows]
+            return self.db._hydrate(self.table, rows, identity_map, related)
+
+    def _select(self, related="prefetch"):
+        if related == "join":
+            clause, params = self._compile(prefix="t0.")
+            return _join_query(self.table)[0] + clause + ";", params
+        clause, params = self._compile()
+        return self.table._schema.select_sql + clause + ";", params
+
+    def explain(self, related="prefetch"):
+        return self.db.explain(*self._select(related))
+
+    def __iter__(self):
+        return iter(self.all())
+
+    # yields rows as it reads them, `chunk_size` at a time with fetchmany, so
+    # memory stays flat however big the table is. "instances" prefetches
+    # foreign keys per chunk (without the session identity map, which would
+    # keep every row alive), "tuples" yields the raw rows in schema.fields
+    # order and "namedtuples" the same rows with field names. the iterator
+    # checks out its own connection until it is exhausted or closed, a
+    # streamed response may well be read after the request let go of its one
+    def iter(self, chunk_size=1000, mode="instances"):
+        assert mode in ITER_MODES, f"Unknown iteration mode '{mode}'"
+        schema = self.table._schema
+        lease = _Lease(self.db.pool)
+        cursor = None
+        try:
+            with self.db._binding(lease):
+                cursor = self.db._execute(*self._select())
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    return
+                if mode == "tuples":
+                    yield from rows
+                elif mode == "namedtuples":
+                    yield from map(schema.row_type._make, rows)
+                else:
+                    with self.db._binding(lease):
+                        instances = self.db._hydrate(self.table, rows, {}, "prefetch")
+                    yield from instances
+        finally:
+            if cursor is not None:
+                cursor.close()
+            lease.release()
+
+    def first(self, related="prefetch"):
+        rows = self.limit(1).all(related=related)
+        return rows[0] if rows else None
+
+    def count(self):
+        name = self.table._schema.name
+        if self._limit is None and self._offset is None:
+            clause, params = self._compile(ordered=False)
+            sql = f"SELECT COUNT(*) FROM {name}{clause};"
+        else:
+            clause, params = self._compile()
+            sql = f"SELECT COUNT(*) FROM (SELECT id FROM {name}{clause});"
+        with self.db._leased():
+            return self.db._execute(sql, params).fetchone()[0]
+
+    def exists(self):
+        clause, params = self._compile(ordered=self._limit is not None or self._offset is not None)
+        sql = f"SELECT EXISTS (SELECT 1 FROM {self.table._schema.name}{clause});"
+        with self.db._leased():
+            return bool(self.db._execute(sql, params).fetchone()[0])
+
+
+def _export_row(row):
+    if isinstance(row, Table):
+        return [row.id] + [_sql_value(getattr(row, name)) for name, _ in row._schema.attributes]
+    return row
+
+
+# turn rows from db.iter() into a response body that streams in constant
+# memory, e.g. resp.stream = csv_stream(db.iter(Book)). instances and
+# namedtuples name their own fields, plain tuples need `fields` for a
+# header line and get none without them
+def csv_stream(rows, fields=None, batch_size=100):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    header_written = fields is not None
+    if fields is not None:
+        writer.writerow(fields)
+
+    for count, row in enumerate(rows, 1):
+        if not header_written:
+            header = row._schema.fields if isinstance(row, Table) else getattr(row, "_fields", None)
+            if header is not None:
+                writer.writerow(header)
+            header_written = True
+        writer.writerow(_export_row(row))
+        if count % batch_size == 0:
+            yield buffer.getvalue().encode("UTF-8")
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue().encode("UTF-8")
+
+
+def jsonl_stream(rows, fields=None, batch_size=100):
+    lines = []
+    for row in rows:
+        names = fields or (row._schema.fields if isinstance(row, Table) else row._fields)
+        lines.append(json.dumps(dict(zip(names, _export_row(row))), default=str))
+        if len(lines) == batch_size:
+            yield ("\n".join(lines) + "\n").encode("UTF-8")
+            lines = []
+    if lines:
+        yield ("\n".join(lines) + "\n").encode("UTF-8")
+
+
+# stands in for a foreign key row until one of its attributes is used, then
+# loads it (through the identity map) and forwards everything to it
+class LazyForeignKey:
+    __slots__ = ("_db", "_table", "_identity_map", "_instance", "id")
+
+    def __init__(self, db, table, id, identity_map):
+        object.__setattr__(self, "_db", db)
+        object.__setattr__(self, "_table", table)
+        object.__setattr__(self, "_identity_map", identity_map)
+        object.__setattr__(self, "_instance", None)
+        object.__setattr__(self, "id", id)
+
+    def resolve(self):
+        if self._instance is None:
+            with self._db._leased():
+                instance = self._db._get(self._table, self.id, "lazy", self._identity_map)
+            if instance is None:
+                raise Exception(f"{self._table.__name__} instance with id {self.id} does not exist")
+            object.__setattr__(self, "_instance", instance)
+        return self._instance
+
+    def __getattr__(self, name):
+        return getattr(self.resolve(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.resolve(), name, value)
+
+    def __repr__(self):
+        return f"<LazyForeignKey {self._table.__name__} id={self.id}>"
     
-    def __setattr__(self, key, value):
-        super().__setattr__(key, value)
-        if key in self._data:
-            self._data[key] = value
-        
-    @classmethod
-    def _get_select_all_sql(cls):
-        SELECT_ALL_SQL = 'SELECT {fields} FROM {name};'
-        
-        fields = ['id']
-        for name, field in inspect.getmembers(cls):
+# everything about a Table subclass that never changes, worked out once when
+# the class is created: its fields in the order every statement lists them
+# (id first, then attributes by name), where plain columns and foreign keys
+# sit in a row, and the SQL itself
+class _Schema:
+    def __init__(self, table):
+        self.name = table.__name__.lower()
+        self.fields = ["id"]
+        self.columns = []
+        self.foreign_keys = []
+        self.attributes = []
+        definitions = ["id INTEGER PRIMARY KEY AUTOINCREMENT"]
+
+        for name, field in inspect.getmembers(table):
             if isinstance(field, Column):
-                fields.append(name)
-            if isinstance(field, ForeignKey):
-                fields.append(name + "_id")
-        
-        sql = SELECT_ALL_SQL.format(name=cls.__name__.lower(), fields=", ".join(fields))
-        return sql, fields
+                self.columns.append((len(self.fields), name, field.member.__set__))
+                self.attributes.append((name, False))
+                self.fields.append(name)
+                definitions.append(f"{name} {field.sql_type}")
+            elif isinstance(field, ForeignKey):
+                self.foreign_keys.append((len(self.fields), name, field.table, field.member.__set__))
+                self.attributes.append((name, True))
+                self.fields.append(name + "_id")
+                definitions.append(f"{name}_id INTEGER")
+
+        # attribute <-> column, a foreign key "author" is the "author_id" column
+        self.attribute_names = dict(zip(self.fields, ["id"] + [name for name, _ in self.attributes]))
+        self.column_names = {**{field: field for field in self.fields}, **{
+            name: field for field, name in self.attribute_names.items()
+        }}
+
+        writable = self.fields[1:]
+        self.create_sql = f"CREATE TABLE IF NOT EXISTS {self.name} ({', '.join(definitions)});"
+        self.select_sql = f"SELECT {', '.join(self.fields)} FROM {self.name}"
+        self.select_all_sql = self.select_sql + ";"
+        self.select_where_sql = self.select_sql + " WHERE id = ?;"
+        self.insert_sql = (
+            f"INSERT INTO {self.name} ({', '.join(writable)}) VALUES ({', '.join('?' * len(writable))});"
+        )
+        self.update_sql = f"UPDATE {self.name} SET {', '.join(f'{field} = ?' for field in writable)} WHERE id = ?"
+        self.delete_sql = f"DELETE FROM {self.name} WHERE id = ?"
+        self.join_query = None
+        self.index_sql = _index_sql(table, self)
+        self.related_tables = frozenset([self.name]).union(
+            *(fk_table._schema.related_tables for _, _, fk_table, _ in self.foreign_keys)
+        )
+        self.row_type = namedtuple(f"{table.__name__}Row", self.fields)
+
+
+# CREATE INDEX IF NOT EXISTS for every Column(index=True or unique=True),
+# every foreign key column and every Index declared on the table. indexes
+# over the same columns are merged into one, named after the Index if there
+# is one and unique if any of them is
+def _index_sql(table, schema):
+    indexes = {}
+    for name, field in inspect.getmembers(table):
+        if isinstance(field, Column) and (field.index or field.unique):
+            columns, index, unique, declared = (name,), f"{schema.name}_{name}", field.unique, False
+        elif isinstance(field, ForeignKey):
+            columns, index, unique, declared = (name + "_id",), f"{schema.name}_{name}_id", False, False
+        elif isinstance(field, Index):
+            unknown = [column for column in field.fields if column not in schema.column_names]
+            assert not unknown, f"{table.__name__} has no fields {', '.join(unknown)} to index"
+            columns = tuple(schema.column_names[column] for column in field.fields)
+            index, unique, declared = f"{schema.name}_{name}", field.unique, True
+        else:
+            continue
+
+        existing = indexes.get(columns)
+        if existing is not None:
+            existing_index, existing_unique, existing_declared = existing
+            if existing_declared and not declared:
+                index = existing_index
+            declared = declared or existing_declared
+            unique = unique or existing_unique
+        indexes[columns] = (index, unique, declared)
+
+    return [
+        f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {index} ON {schema.name} ({', '.join(columns)});"
+        for columns, (index, unique, _) in indexes.items()
+    ]
+
+
+# rows keep their values in slots instead of an instance __dict__: every
+# Column and ForeignKey declared on a Table subclass gets a "_<name>" slot
+# that the field reads and writes as a data descriptor
+class TableMeta(type):
+    def __new__(mcs, name, bases, namespace, **kwargs):
+        if "__slots__" not in namespace:
+            namespace["__slots__"] = tuple(
+                "_" + key for key, value in namespace.items() if isinstance(value, (Column, ForeignKey))
+            )
+        return super().__new__(mcs, name, bases, namespace, **kwargs)
+
+
+class Table(metaclass=TableMeta):
+    __slots__ = ("id",)
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._schema = _Schema(cls)
+
+    def __init__(self, **kwargs):
+        self.id = kwargs.pop("id", None)
+        for name, _ in self._schema.attributes:
+            setattr(self, name, kwargs.pop(name, None))
+        if kwargs:
+            raise TypeError(f"{type(self).__name__} has no fields {', '.join(kwargs)}")
+
+    def __repr__(self):
+        return f"<{type(self).__name__} id={self.id}>"
 
     @classmethod
     def _get_select_where_sql(cls, id):
-        SELECT_WHERE_SQL = 'SELECT {fields} FROM {name} WHERE id = ?;'
-        fields = ["id"]
-        for name, field in inspect.getmembers(cls):
-            if isinstance(field, Column):
-                fields.append(name)
-            if isinstance(field, ForeignKey):
-                fields.append(name + "_id")
-            
-        sql = SELECT_WHERE_SQL.format(name=cls.__name__.lower(), fields=", ".join(fields))
-        params = [id]
-        return sql, fields, params
+        return cls._schema.select_where_sql, list(cls._schema.fields), [id]
     
     @classmethod
     def _get_create_sql(cls):
-        CREATE_TABLE_SQL = "CREATE TABLE IF NOT EXISTS {name} ({fields});"
-        fields = [
-            "id INTEGER PRIMARY KEY AUTOINCREMENT",
-        ]
-
-        for name, field in inspect.getmembers(cls):
-            if isinstance(field, Column):
-                fields.append(f"{name} {field.sql_type}")
-            elif isinstance(field, ForeignKey):
-                fields.append(f"{name}_id INTEGER")
-
-        fields = ", ".join(fields)
-        name = cls.__name__.lower()
-        return CREATE_TABLE_SQL.format(name=name, fields=fields)
+        return cls._schema.create_sql
     
     @classmethod
     def _get_select_all_sql(cls):
-        SELECT_ALL_SQL = "SELECT {fields} FROM {name};"
-
-        fields = ["id"]
-        for name, field in inspect.getmembers(cls):
-            if isinstance(field, Column):
-                fields.append(name)
-            if isinstance(field, ForeignKey):
-                fields.append(name + "_id")
-        
-        sql = SELECT_ALL_SQL.format(name=cls.__name__.lower(), fields=", ".join(fields))
-
-        return sql, fields
+        return cls._schema.select_all_sql, list(cls._schema.fields)
+    
+    @classmethod
+    def _get_index_sql(cls):
+        return list(cls._schema.index_sql)
     
     @classmethod
     def _get_delete_sql(cls, id):
-        DELETE_SQL = 'DELETE FROM {name} WHERE id = ?'
-        
-        sql = DELETE_SQL.format(name=cls.__name__.lower())
-        
-        return sql, [id]
+        return cls._schema.delete_sql, [id]
+
+    def _values(self):
+        return [
+            getattr(self, name).id if foreign_key else getattr(self, name)
+            for name, foreign_key in self._schema.attributes
+        ]
     
     def _get_insert_sql(self):
-        INSERT_SQL = "INSERT INTO {name} ({fields}) VALUES ({placeholders});"
-        cls = self.__class__
-        fields = []
-        placeholders = []
-        values = []
-        
-        for name, field in inspect.getmembers(cls):
-            if isinstance(field, Column):
-                fields.append(name)
-                values.append(getattr(self, name))
-                placeholders.append("?")
-            elif isinstance(field, ForeignKey):
-                fields.append(name + "_id")
-                values.append(getattr(self, name).id)
-                placeholders.append("?")
-        
-        fields = ", ".join(fields)
-        placeholders = ", ".join(placeholders)
-        
-        sql = INSERT_SQL.format(name=cls.__name__.lower(), fields=fields, placeholders=placeholders)
-        
-        return sql, values
+        return self._schema.insert_sql, self._values()
     
     def _get_update_sql(self):
-        UPDATE_SQL = "UPDATE {name} SET {fields} WHERE id = ?"
-        cls = self.__class__
-        fields = []
-        values = []
-        
-        for name, field in inspect.getmembers(cls):
-            if isinstance(field, Column):
-                fields.append(name)
-                values.append(getattr(self, name))
-            elif isinstance(field, ForeignKey):
-                fields.append(name + "_id")
-                values.append(getattr(self, name).id)
-        
-        values.append(getattr(self, 'id'))
-        
-        sql = UPDATE_SQL.format(
-            name=cls.__name__.lower(),
-            fields=', '.join([f"{field} = ?" for field in fields])
-        )
-        
-        return sql, values
+        values = self._values()
+        values.append(self.id)
+        return self._schema.update_sql, values
+
+
+class _Field:
+    name = None
+    member = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        self.member = owner.__dict__["_" + name]
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        return self.member.__get__(instance, owner)
+
+    def __set__(self, instance, value):
+        self.member.__set__(instance, value)
                 
     
-class Column:
-    def __init__(self, column_type):
+class Column(_Field):
+    def __init__(self, column_type, index=False, unique=False):
         self.type = column_type
+        self.index = index
+        self.unique = unique
         
     @property
     def sql_type(self):
@@ -211,6 +1088,47 @@ class Column:
         }
         return SQLITE_TYPE_MAP[self.type]
 
-class ForeignKey:
+class ForeignKey(_Field):
     def __init__(self, table):
-        self.table = table
\ No newline at end of file
+        self.table = table
+
+
+# a composite index, declared on the table like a column:
+#   by_author = Index("author", "published")
+class Index:
+    def __init__(self, *fields, unique=False):
+        assert fields, "An index needs at least one field"
+        self.fields = fields
+        self.unique = unique
+
+
+# checks a connection out of the pool for every request and returns it once
+# the response is ready, so a threaded server never needs more connections
+# than it has requests in flight. on an event loop waiting for a connection
+# happens in the loop's default executor instead of blocking the loop
+class ConnectionMiddleware(Middleware):
+    def __init__(self, app, db):
+        super().__init__(app)
+        self.db = db
+
+    def process_request(self, req):
+        try:
+            lease = _Lease(self.db.pool, timeout=0)
+        except PoolTimeout:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                lease = _Lease(self.db.pool)
+            else:
+                return self._wait(loop)
+        _bind(self.db, lease)
+
+    async def _wait(self, loop):
+        _bind(self.db, await loop.run_in_executor(None, _Lease, self.db.pool))
+
+    def process_response(self, req, resp):
+        bound = dict(_connections.get() or {})
+        lease = bound.pop(self.db, None)
+        if lease is not None:
+            lease.release()
+            _connections.set(bound)
@@ -0,0 +1,203 @@
+import os
+import re
+import sys
+import hmac
+import time
+import uuid
+import random
+import hashlib
+import logging
+import cProfile
+import threading
+from contextlib import contextmanager
+from collections import Counter, deque
+from time import perf_counter
+from .orm import query_log
+
+PROFILE_MODES = ("cprofile", "sampling")
+PROFILE_HEADER = "X-Highball-Profile"
+
+
+# what the API keeps about one instrumented request while it runs. under
+# ASGI `profiler` is set when the request should be profiled and the profile
+# is only started around the handler, in the thread that runs it
+class RequestTrace:
+    __slots__ = ("started", "queries", "token", "profile", "profiler")
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.queries = None
+        self.token = None
+        self.profile = None
+        self.profiler = None
+
+    @contextmanager
+    def profiling(self):
+        if self.profiler is not None and self.profile is None:
+            self.profile = self.profiler.begin()
+        try:
+            yield
+        finally:
+            # cProfile has to be disabled from the thread that enabled it
+            if isinstance(self.profile, cProfile.Profile):
+                self.profile.disable()
+
+    def run(self, func, *args, **kwargs):
+        with self.profiling():
+            return func(*args, **kwargs)
+
+
+class _Sampler(threading.Thread):
+    def __init__(self, thread_id, interval):
+        super().__init__(name="highball-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+# profiles a request when it carries a valid signed header, or at random for
+# `sample_rate` of all requests. a signature is "<expiry>.<hmac>" and only
+# works for its path until the expiry timestamp. "cprofile" writes a pstats .prof file and
+# "sampling" a collapsed-stack file that flame graph tools read directly.
+# only one request is profiled at a time, the others run unprofiled
+class Profiler:
+    def __init__(self, output_dir, sample_rate=0.0, secret=None, mode="cprofile", interval=0.001,
+                 header=PROFILE_HEADER):
+        assert mode in PROFILE_MODES, f"Unknown profiling mode '{mode}'"
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.sample_rate = sample_rate
+        self.secret = secret.encode() if isinstance(secret, str) else secret
+        self.mode = mode
+        self.interval = interval
+        self.header = header
+        self._active = threading.Lock()
+
+    def sign(self, path, expires_in=3600, now=None):
+        expires = int((time.time() if now is None else now) + expires_in)
+        return f"{expires}.{self._digest(path, expires)}"
+
+    def _digest(self, path, expires):
+        return hmac.new(self.secret, f"{expires}:{path}".encode(), hashlib.sha256).hexdigest()
+
+    def wants(self, request):
+        if self.secret is not None:
+            signature = request.headers.get(self.header)
+            if signature is not None and self._verify(signature, request.path):
+                return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def _verify(self, signature, path):
+        expires, _, digest = signature.partition(".")
+        if not expires.isascii() or not expires.isdigit() or int(expires) < time.time():
+            return False
+        # header values are latin-1, compare_digest only takes ASCII strings
+        return hmac.compare_digest(digest.encode("latin1", "replace"), self._digest(path, int(expires)).encode())
+
+    def start(self, request):
+        if not self.wants(request):
+            return None
+        return self.begin()
+
+    # profiles the calling thread, None while another request is profiled
+    def begin(self):
+        if not self._active.acquire(blocking=False):
+            return None
+        if self.mode == "sampling":
+            sampler = _Sampler(threading.get_ident(), self.interval)
+            sampler.start()
+            return sampler
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def stop(self, profile, request, route):
+        name = re.sub(r"[^a-zA-Z0-9]+", "_", route).strip("_") or "root"
+        path = os.path.join(
+            self.output_dir, f"{int(time.time() * 1000)}-{request.method}-{name}-{uuid.uuid4().hex[:6]}"
+        )
+        try:
+            if isinstance(profile, _Sampler):
+                profile.stop()
+                path += ".collapsed"
+                with open(path, "w") as f:
+                    for stack, count in profile.stacks.most_common():
+                        f.write(f"{stack} {count}\n")
+            else:
+                profile.disable()
+                path += ".prof"
+                profile.dump_stats(path)
+        finally:
+            self._active.release()
+        return path
+
+
+# requests slower than `threshold` seconds are logged with their route, where
+# the time went and the SQL they ran. the last `keep` entries stay in memory
+class SlowRequestLog:
+    def __init__(self, threshold=0.5, logger=None, keep=100):
+        self.threshold = threshold
+        self.logger = logger or logging.getLogger("highball.slow_requests")
+        self.entries = deque(maxlen=keep)
+
+    def record(self, request, route, status, timings, queries):
+        entry = {
+            "method": request.method,
+            "path": request.path,
+            "route": route,
+            "status": status,
+            "timings": dict(timings),
+            "queries": list(queries or ()),
+        }
+        self.entries.append(entry)
+
+        phases = ", ".join(
+            f"{phase} {timings[phase] * 1000:.1f}ms"
+            for phase in ("middleware", "routing", "handler", "serialization") if phase in timings
+        )
+        lines = [
+            f"Slow request {request.method} {request.path} ({route}) {status} "
+            f"{timings['total'] * 1000:.1f}ms: {phases}, {len(entry['queries'])} queries"
+        ]
+        lines.extend("    " + query for query in entry["queries"])
+        self.logger.warning("\n".join(lines))
+        return entry
+
+
+# with `deferred` the profile isn't started here but by trace.profiling()
+def begin_trace(request, profiler=None, slow_request_log=None, deferred=False):
+    request.timings = {}
+    trace = RequestTrace()
+    if slow_request_log is not None:
+        trace.queries = []
+        trace.token = query_log.set(trace.queries)
+    if profiler is not None:
+        if not deferred:
+            trace.profile = profiler.start(request)
+        elif profiler.wants(request):
+            trace.profiler = profiler
+    request.trace = trace
+    return trace
+
+
+def end_trace(trace):
+    if trace.token is not None:
+        query_log.reset(trace.token)
+        trace.token = None
+    return perf_counter() - trace.started
@@ -0,0 +1,187 @@
+import io
+import json
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qsl, quote
+
+FORM_CONTENT_TYPE = "application/x-www-form-urlencoded"
+
+
+# a dict holding the last value for every key, like webob's MultiDict,
+# that still keeps every pair around for getall()
+class MultiDict(dict):
+    __slots__ = ("_items",)
+
+    def __init__(self, items=()):
+        self._items = list(items)
+        super().__init__(self._items)
+
+    def getall(self, key):
+        return [value for name, value in self._items if name == key]
+
+    def allitems(self):
+        return list(self._items)
+
+
+class EnvironHeaders:
+    __slots__ = ("environ",)
+
+    def __init__(self, environ):
+        self.environ = environ
+
+    def __getitem__(self, name):
+        return self.environ[_environ_key(name)]
+
+    def __contains__(self, name):
+        return _environ_key(name) in self.environ
+
+    def get(self, name, default=None):
+        return self.environ.get(_environ_key(name), default)
+
+    def items(self):
+        for key, value in self.environ.items():
+            if key.startswith("HTTP_"):
+                yield key[5:].replace("_", "-").title(), value
+            elif key in ("CONTENT_TYPE", "CONTENT_LENGTH") and value:
+                yield key.replace("_", "-").title(), value
+
+    def __iter__(self):
+        return (name for name, _ in self.items())
+
+
+def _environ_key(name):
+    key = name.upper().replace("-", "_")
+    if key in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+        return key
+    return "HTTP_" + key
+
+
+# nothing is parsed until it's asked for, most handlers only need the path
+# and maybe one query parameter
+class Request:
+    __slots__ = ("environ", "match", "timings", "trace", "_path", "_body", "_GET", "_POST", "_cookies", "_json")
+
+    def __init__(self, environ):
+        self.environ = environ
+        self.match = None
+        self.timings = None
+        self.trace = None
+        self._path = None
+        self._body = None
+        self._GET = None
+        self._POST = None
+        self._cookies = None
+        self._json = None
+
+    @property
+    def method(self):
+        return self.environ["REQUEST_METHOD"]
+
+    @property
+    def path(self):
+        if self._path is None:
+            path = self.environ.get("SCRIPT_NAME", "") + self.environ.get("PATH_INFO", "")
+            self._path = path.encode("latin1").decode("utf8", "replace")
+        return self._path
+
+    @property
+    def path_info(self):
+        return self.environ.get("PATH_INFO", "").encode("latin1").decode("utf8", "replace")
+
+    @property
+    def query_string(self):
+        return self.environ.get("QUERY_STRING", "")
+
+    @property
+    def scheme(self):
+        return self.environ.get("wsgi.url_scheme", "http")
+
+    @property
+    def host(self):
+        host = self.environ.get("HTTP_HOST")
+        if host is None:
+            host = self.environ.get("SERVER_NAME", "localhost")
+            port = self.environ.get("SERVER_PORT")
+            if port and port != ("443" if self.scheme == "https" else "80"):
+                host += ":" + port
+        return host
+
+    @property
+    def url(self):
+        url = self.scheme + "://" + self.host + quote(self.path)
+        if self.query_string:
+            url += "?" + self.query_string
+        return url
+
+    @property
+    def remote_addr(self):
+        return self.environ.get("REMOTE_ADDR")
+
+    @property
+    def headers(self):
+        return EnvironHeaders(self.environ)
+
+    @property
+    def content_type(self):
+        return self.environ.get("CONTENT_TYPE", "").split(";", 1)[0].strip()
+
+    @property
+    def cookies(self):
+        if self._cookies is None:
+            cookie = SimpleCookie()
+            cookie.load(self.environ.get("HTTP_COOKIE", ""))
+            self._cookies = {name: morsel.value for name, morsel in cookie.items()}
+        return self._cookies
+
+    @property
+    def body(self):
+        if self._body is None:
+            try:
+                length = int(self.environ.get("CONTENT_LENGTH") or 0)
+            except ValueError:
+                length = 0
+            stream = self.environ.get("wsgi.input")
+            self._body = stream.read(length) if stream is not None and length > 0 else b""
+            self.environ["wsgi.input"] = io.BytesIO(self._body)
+        return self._body
+
+    @property
+    def text(self):
+        return self.body.decode("utf8")
+
+    @property
+    def json(self):
+        if self._json is None:
+            self._json = json.loads(self.body)
+        return self._json
+
+    json_body = json
+
+    @property
+    def GET(self):
+        if self._GET is None:
+            self._GET = MultiDict(parse_qsl(self.query_string, keep_blank_values=True))
+        return self._GET
+
+    @property
+    def POST(self):
+        if self._POST is None:
+            content_type = self.content_type
+            if content_type == FORM_CONTENT_TYPE:
+                body = self.body.decode("utf8", "replace")
+                self._POST = MultiDict(parse_qsl(body, keep_blank_values=True))
+            elif content_type.startswith("multipart/"):
+                self._POST = self._multipart()
+            else:
+                self._POST = MultiDict()
+        return self._POST
+
+    @property
+    def params(self):
+        return MultiDict(self.GET.allitems() + self.POST.allitems())
+
+    # multipart bodies are rare enough that they're handed to webob
+    def _multipart(self):
+        from webob import Request as WebObRequest
+
+        environ = dict(self.environ, **{"wsgi.input": io.BytesIO(self.body)})
+        return MultiDict(WebObRequest(environ).POST.items())
@@ -1,31 +1,235 @@
+import os
 import json
-from webob import Response as WebObResponse
+import mimetypes
+from email.utils import formatdate
+from http import HTTPStatus
+from http.cookies import SimpleCookie
+
+CHUNK_SIZE = 64 * 1024
+DEFAULT_CONTENT_TYPE = "text/html"
+
+STATUS_LINES = {status.value: f"{status.value} {status.phrase}" for status in HTTPStatus}
+_CONTENT_TYPE_HEADERS = {}
+
+
+def json_encoder(default=None, compact=True, **options):
+    separators = (",", ":") if compact else None
+    return json.JSONEncoder(separators=separators, default=default, **options).encode
+
 
 class Response:
-    def __init__(self):
+    json_encoder = staticmethod(json_encoder())
+    
+    def __init__(self, json_encoder=None):
+        if json_encoder is not None:
+            self.json_encoder = json_encoder
         self.json = None
         self.html = None
         self.text = None
         self.content_type = None
         self.body = None
+        self.stream = None
+        self.file = None
         self.status_code = 200
-        
+        self.headers = {}
+        self.cookies = []
+        self._encoded_from = None
+
+    @property
+    def streaming(self):
+        return self.stream is not None or self.file is not None
+
     def __call__(self, environ, start_response):
+        if self.file is not None:
+            return self._file_response(environ, start_response)
+
+        if self.stream is not None:
+            return self._stream_response(environ, start_response)
+
+        if self.status_code in (204, 304):
+            headers = []
+            self._extend_headers(headers)
+            start_response(_status_line(self.status_code), headers)
+            return []
+
         self.set_body_and_content_type()
-        response = WebObResponse(
-            body=self.body, content_type=self.content_type, status=self.status_code
-        )
-        return response(environ=environ, start_response=start_response)
-    
+        body = self.body
+        if body is None:
+            body = b""
+
+        headers = [
+            _content_type_header(self.content_type or DEFAULT_CONTENT_TYPE),
+            ("Content-Length", str(len(body))),
+        ]
+        self._extend_headers(headers)
+        start_response(_status_line(self.status_code), headers)
+
+        if environ["REQUEST_METHOD"] == "HEAD":
+            return []
+        return [body]
+
+    # middleware may need the encoded body before the response is sent. it is
+    # encoded again when the response is sent, so changes made to json/html/
+    # text in between still reach the client, unless a middleware replaced
+    # the body since and the same objects are still set
     def set_body_and_content_type(self):
+        source = (self.json, self.html, self.text)
+        if self._encoded_from is not None and all(
+            a is b for a, b in zip(source, self._encoded_from)
+        ):
+            return
+        self._encoded_from = None
+
         if self.json is not None:
-            self.body = json.dumps(self.json).encode("UTF-8")
+            # bytes are JSON someone already encoded, a str is just a value
+            body = self.json
+            if not isinstance(body, bytes):
+                body = self.json_encoder(body).encode("UTF-8")
+            self.body = body
             self.content_type = "application/json"
-            
+
         if self.html is not None:
-            self.body = self.html.encode()
+            self.body = self.html.encode("UTF-8")
             self.content_type = "text/html"
-            
+
         if self.text is not None:
-            self.body = self.text
-            self.content_type = "text/plain"
\ No newline at end of file
+            self.body = self.text.encode("UTF-8")
+            self.content_type = "text/plain"
+
+    # for middleware that rewrite the encoded body, e.g. to compress it
+    def replace_body(self, body):
+        self.body = body
+        self._encoded_from = (self.json, self.html, self.text)
+
+    def set_cookie(self, name, value="", max_age=None, expires=None, path="/",
+                   domain=None, secure=False, httponly=False, samesite=None):
+        cookie = SimpleCookie()
+        cookie[name] = value
+        morsel = cookie[name]
+        if max_age is not None:
+            morsel["max-age"] = max_age
+        if expires is not None:
+            morsel["expires"] = expires
+        if path is not None:
+            morsel["path"] = path
+        if domain is not None:
+            morsel["domain"] = domain
+        if samesite is not None:
+            morsel["samesite"] = samesite
+        morsel["secure"] = secure
+        morsel["httponly"] = httponly
+        self.cookies.append(morsel.OutputString())
+
+    def delete_cookie(self, name, path="/", domain=None):
+        self.set_cookie(name, max_age=0, expires="Thu, 01 Jan 1970 00:00:00 GMT", path=path, domain=domain)
+
+    def _extend_headers(self, headers):
+        if self.headers:
+            headers.extend(self.headers.items())
+        for cookie in self.cookies:
+            headers.append(("Set-Cookie", cookie))
+
+    # no Content-Length is sent, so HTTP/1.1 servers use chunked transfer
+    def _stream_response(self, environ, start_response):
+        headers = [_content_type_header(self.content_type or "application/octet-stream")]
+        self._extend_headers(headers)
+        start_response(_status_line(self.status_code), headers)
+        return _encode_chunks(self.stream)
+
+    def _file_response(self, environ, start_response):
+        size = os.path.getsize(self.file)
+        content_type = self.content_type or mimetypes.guess_type(self.file)[0] or "application/octet-stream"
+        headers = [
+            _content_type_header(content_type),
+            ("Accept-Ranges", "bytes"),
+            ("Last-Modified", formatdate(os.path.getmtime(self.file), usegmt=True)),
+        ]
+        self._extend_headers(headers)
+
+        byte_range = None
+        if self.status_code == 200 and "HTTP_RANGE" in environ:
+            byte_range = _parse_range(environ["HTTP_RANGE"], size)
+            if byte_range is False:
+                headers = [("Content-Range", f"bytes */{size}"), ("Content-Length", "0")]
+                start_response(_status_line(416), headers)
+                return [b""]
+
+        file = open(self.file, "rb")
+        if byte_range is None:
+            headers.append(("Content-Length", str(size)))
+            start_response(_status_line(self.status_code), headers)
+            file_wrapper = environ.get("wsgi.file_wrapper")
+            if file_wrapper is not None:
+                return file_wrapper(file, CHUNK_SIZE)
+            return _read_file(file, size)
+
+        start, end = byte_range
+        file.seek(start)
+        headers.append(("Content-Range", f"bytes {start}-{end}/{size}"))
+        headers.append(("Content-Length", str(end - start + 1)))
+        start_response(_status_line(206), headers)
+        return _read_file(file, end - start + 1)
+
+
+def _status_line(status_code):
+    status_line = STATUS_LINES.get(status_code)
+    if status_line is None:
+        status_line = f"{status_code} Unknown"
+    return status_line
+
+
+# text types get a charset appended like WebOb used to do, and the tuple is
+# built once per distinct content type
+def _content_type_header(content_type):
+    header = _CONTENT_TYPE_HEADERS.get(content_type)
+    if header is None:
+        value = content_type
+        if value.startswith("text/") and "charset" not in value:
+            value += "; charset=UTF-8"
+        header = _CONTENT_TYPE_HEADERS[content_type] = ("Content-Type", value)
+    return header
+
+
+def _encode_chunks(stream):
+    try:
+        for chunk in stream:
+            yield chunk.encode("UTF-8") if isinstance(chunk, str) else chunk
+    finally:
+        if hasattr(stream, "close"):
+            stream.close()
+
+
+def _read_file(file, length):
+    try:
+        while length > 0:
+            chunk = file.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        file.close()
+
+
+# returns (start, end) for a single satisfiable range, False when the range
+# can't be satisfied and None when the header should be ignored
+def _parse_range(header, size):
+    unit, _, ranges = header.partition("=")
+    if unit.strip() != "bytes" or "," in ranges:
+        return None
+
+    start, _, end = ranges.strip().partition("-")
+    try:
+        if start == "":
+            length = int(end)
+            if length == 0:
+                return False
+            return max(size - length, 0), size - 1
+        start = int(start)
+        end = int(end) if end else size - 1
+    except ValueError:
+        return None
+
+    if start >= size or end < start:
+        return False
+    return start, min(end, size - 1)
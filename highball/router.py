@@ -0,0 +1,255 @@
+import inspect
+import os
+import re
+from types import MappingProxyType
+
+PARAM_RE = re.compile(r"{([a-zA-Z_][a-zA-Z0-9_]*)(?::([a-z]*))?}")
+
+# format spec -> (regex, python type, priority); lower priority is tried first
+CONVERTERS = {
+    "d": (r"-?\d+", int, 1),
+    "f": (r"-?\d+(?:\.\d+)?", float, 2),
+    "w": (r"\w+", str, 3),
+    "": (r"[^/]+", str, 4),
+    "path": (r".+", str, 5),
+}
+MIXED_PRIORITY = 0
+
+HTTP_METHODS = ("get", "post", "put", "patch", "delete", "head", "options")
+DEFAULT_ALLOWED_METHODS = ("get", "post", "put", "delete", "options")
+INSTANCE_MODES = ("request", "shared", "worker")
+
+
+# method -> callable is built once here, so dispatch is a single dict lookup.
+# class based handlers get a fresh instance per request by default, one
+# instance for the whole app with "shared", or one per process with "worker"
+class Route:
+    def __init__(self, path, handler, allowed_methods=None, instance="request"):
+        assert instance in INSTANCE_MODES, f"Unknown instance mode '{instance}'"
+        self.path = path
+        self.handler = handler
+        self.allowed_methods = allowed_methods
+        self.instance = instance
+        self._worker = (None, None)
+
+        if inspect.isclass(handler):
+            methods, async_methods = self._build_class_methods()
+        else:
+            if allowed_methods is None:
+                allowed_methods = DEFAULT_ALLOWED_METHODS
+            methods = {method.lower(): handler for method in allowed_methods}
+            async_methods = set(methods) if inspect.iscoroutinefunction(handler) else set()
+
+        self.methods = MappingProxyType(methods)
+        self.async_methods = frozenset(async_methods)
+        self.allow = ", ".join(method.upper() for method in self.methods)
+
+    def _build_class_methods(self):
+        cls = self.handler
+        if self.allowed_methods is None:
+            names = HTTP_METHODS
+        else:
+            names = [method.lower() for method in self.allowed_methods]
+
+        methods, async_methods = {}, set()
+        resource = cls() if self.instance == "shared" else None
+        for name in names:
+            function = getattr(cls, name, None)
+            if not callable(function):
+                continue
+            if resource is not None:
+                methods[name] = getattr(resource, name)
+            else:
+                methods[name] = self._bind(function)
+            if inspect.iscoroutinefunction(function):
+                async_methods.add(name)
+        return methods, async_methods
+
+    def _bind(self, function):
+        if self.instance == "worker":
+            def endpoint(request, response, **kwargs):
+                return function(self._worker_resource(), request, response, **kwargs)
+        else:
+            cls = self.handler
+
+            def endpoint(request, response, **kwargs):
+                return function(cls(), request, response, **kwargs)
+        return endpoint
+
+    def _worker_resource(self):
+        pid, resource = self._worker
+        if pid != os.getpid():
+            resource = self.handler()
+            self._worker = (os.getpid(), resource)
+        return resource
+
+
+class _Segment:
+    def __init__(self, key, regex, types, priority):
+        self.key = key
+        self.regex = re.compile(regex)
+        self.types = types
+        self.priority = priority
+        self.greedy = priority == CONVERTERS["path"][2]
+        self.node = _Node()
+
+    def match(self, value):
+        match = self.regex.fullmatch(value)
+        if match is None:
+            return None
+        return {name: self.types[name](v) for name, v in match.groupdict().items()}
+
+
+class _Node:
+    def __init__(self):
+        self.static = {}
+        self.dynamic = []
+        self.route = None
+        self.mount = None
+
+    def child(self, segment):
+        for existing in self.dynamic:
+            if existing.key == segment.key:
+                return existing.node
+        self.dynamic.append(segment)
+        self.dynamic.sort(key=lambda s: s.priority)
+        return segment.node
+
+
+# the key ignores parameter names, so `{id}` and `{name}` in the same
+# position land on the same trie node and are reported as ambiguous
+def _compile_segment(segment, names):
+    regex, key, types = [], [], {}
+    position = 0
+    priority = None
+    for match in PARAM_RE.finditer(segment):
+        name, spec = match.group(1), match.group(2) or ""
+        assert spec in CONVERTERS, f"Unknown converter '{spec}' in route"
+        assert name not in names, f"Duplicate parameter '{name}' in route"
+        names.add(name)
+        assert spec != "path" or match.group(0) == segment, \
+            "'path' converter must take up a whole segment"
+
+        literal = segment[position:match.start()]
+        regex.append(re.escape(literal))
+        key.append(literal)
+        pattern, type_, priority = CONVERTERS[spec]
+        regex.append(f"(?P<{name}>{pattern})")
+        key.append("{" + spec + "}")
+        types[name] = type_
+        position = match.end()
+
+    literal = segment[position:]
+    regex.append(re.escape(literal))
+    key.append(literal)
+
+    if len(types) > 1 or "".join(key) != key[1]:
+        priority = MIXED_PRIORITY
+    return _Segment("".join(key), "".join(regex), types, priority)
+
+
+# parameter-free paths live in a dict, patterns are split on `/` into a
+# segment trie where static children are tried before parameters
+class Router:
+    def __init__(self):
+        self._static = {}
+        self._root = _Node()
+        self._patterns = {}
+        self._mounts = False
+
+    def __contains__(self, path):
+        return path in self._patterns
+
+    def __iter__(self):
+        return iter(self._patterns.values())
+
+    def __len__(self):
+        return len(self._patterns)
+
+    def add(self, route):
+        path = route.path
+        assert path not in self._patterns, "Such route already exist"
+
+        if not PARAM_RE.search(path):
+            self._static[path] = route
+            self._patterns[path] = route
+            return route
+
+        node = self._root
+        names = set()
+        segments = path.split("/")
+        for index, segment in enumerate(segments):
+            if not PARAM_RE.search(segment):
+                node = node.static.setdefault(segment, _Node())
+                continue
+            compiled = _compile_segment(segment, names)
+            assert not compiled.greedy or index == len(segments) - 1, \
+                "'path' converter must be the last segment of a route"
+            node = node.child(compiled)
+
+        assert node.route is None, f"Route '{path}' is ambiguous with '{node.route.path}'"
+        node.route = route
+        self._patterns[path] = route
+        return route
+
+    # a mounted WSGI app gets every path under `prefix`, before any route
+    def mount(self, prefix, app):
+        prefix = prefix.rstrip("/")
+        assert prefix and not PARAM_RE.search(prefix), "Mount prefix must be a static path"
+        node = self._root
+        for segment in prefix.split("/"):
+            node = node.static.setdefault(segment, _Node())
+        assert node.mount is None, f"Something is already mounted at '{prefix}'"
+        node.mount = (prefix, app)
+        self._mounts = True
+
+    def match_mount(self, path):
+        if not self._mounts:
+            return None, None, None
+        node = self._root
+        for segment in path.split("/"):
+            node = node.static.get(segment)
+            if node is None:
+                break
+            if node.mount is not None:
+                prefix, app = node.mount
+                return app, prefix, path[len(prefix):]
+        return None, None, None
+
+    def match(self, path):
+        route = self._static.get(path)
+        if route is not None:
+            return route, {}
+
+        kwargs = {}
+        route = self._match(self._root, path.split("/"), 0, kwargs)
+        if route is None:
+            return None, None
+        return route, kwargs
+
+    def _match(self, node, segments, index, kwargs):
+        if index == len(segments):
+            return node.route
+
+        child = node.static.get(segments[index])
+        if child is not None:
+            route = self._match(child, segments, index + 1, kwargs)
+            if route is not None:
+                return route
+
+        for segment in node.dynamic:
+            if segment.greedy:
+                values = segment.match("/".join(segments[index:]))
+                if values is not None and segment.node.route is not None:
+                    kwargs.update(values)
+                    return segment.node.route
+                continue
+            values = segment.match(segments[index])
+            if values is None:
+                continue
+            route = self._match(segment.node, segments, index + 1, kwargs)
+            if route is not None:
+                kwargs.update(values)
+                return route
+
+        return None
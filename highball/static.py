@@ -0,0 +1,105 @@
+import os
+import sys
+import json
+import gzip
+import hashlib
+import tempfile
+from whitenoise import WhiteNoise
+
+MANIFEST_NAME = "staticfiles.json"
+HASH_LENGTH = 12
+HASHED_NAME_RE = r"\.[0-9a-f]{%d}\.[^./]+$" % HASH_LENGTH
+COMPRESSIBLE_EXTENSIONS = (
+    ".css", ".js", ".mjs", ".json", ".map", ".svg", ".html", ".htm", ".txt", ".xml", ".csv",
+)
+
+
+def hashed_name(name, content):
+    digest = hashlib.md5(content).hexdigest()[:HASH_LENGTH]
+    root, ext = os.path.splitext(name)
+    return f"{root}.{digest}{ext}"
+
+
+def _write_atomic(path, content):
+    if os.path.exists(path) and os.path.getsize(path) == len(content):
+        with open(path, "rb") as f:
+            if f.read() == content:
+                return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb") as tmp:
+        tmp.write(content)
+    os.replace(tmp_path, path)
+
+
+# copies every file under `static_dir` into `output_dir` next to a
+# content-hashed copy and a .gz variant for text assets, then writes a
+# manifest mapping original names to hashed ones. files are replaced
+# atomically, so running it from several workers at once is harmless
+def collect_static(static_dir, output_dir):
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = {}
+    for root, _, files in os.walk(static_dir):
+        for file_name in files:
+            source = os.path.join(root, file_name)
+            name = os.path.relpath(source, static_dir).replace(os.sep, "/")
+            with open(source, "rb") as f:
+                content = f.read()
+
+            hashed = hashed_name(name, content)
+            manifest[name] = hashed
+            for target in (name, hashed):
+                _write_atomic(os.path.join(output_dir, target), content)
+                if name.endswith(COMPRESSIBLE_EXTENSIONS):
+                    compressed = gzip.compress(content, compresslevel=9, mtime=0)
+                    if len(compressed) < len(content):
+                        _write_atomic(os.path.join(output_dir, target + ".gz"), compressed)
+
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    fd, tmp_path = tempfile.mkstemp(dir=output_dir)
+    with os.fdopen(fd, "w") as tmp:
+        json.dump({"paths": manifest}, tmp, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+    return manifest
+
+
+def load_manifest(output_dir):
+    try:
+        with open(os.path.join(output_dir, MANIFEST_NAME)) as f:
+            return json.load(f)["paths"]
+    except FileNotFoundError:
+        return {}
+
+
+# serves `static_dir` as it is, or when `build_dir` is given the collected
+# copies from there. hashed names are cached forever by browsers and
+# WhiteNoise picks the precompressed .gz variants on its own
+class StaticFiles:
+    def __init__(self, app, static_dir="static", url_prefix="/static", build_dir=None, max_age=60):
+        self.url_prefix = url_prefix.rstrip("/")
+        self.manifest = {}
+        root = static_dir
+        if build_dir is not None:
+            if os.path.isdir(static_dir):
+                self.manifest = collect_static(static_dir, build_dir)
+            else:
+                self.manifest = load_manifest(build_dir)
+            root = build_dir
+
+        self.whitenoise = WhiteNoise(
+            app, root=root, max_age=max_age, immutable_file_test=HASHED_NAME_RE
+        )
+
+    def __call__(self, environ, start_response):
+        return self.whitenoise(environ, start_response)
+
+    def url(self, name):
+        name = name.lstrip("/")
+        return f"{self.url_prefix}/{self.manifest.get(name, name)}"
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit("usage: python -m highball.static STATIC_DIR BUILD_DIR")
+    for name, hashed in sorted(collect_static(sys.argv[1], sys.argv[2]).items()):
+        print(f"{name} -> {hashed}")
@@ -0,0 +1,105 @@
+import os
+import time
+import threading
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+from .cache import LRUCache
+
+TEMPLATE_MODES = ("development", "production")
+
+
+class TemplateStats:
+    __slots__ = ("compiles", "compile_time", "renders", "render_time")
+
+    def __init__(self):
+        self.compiles = 0
+        self.compile_time = 0.0
+        self.renders = 0
+        self.render_time = 0.0
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class TimedEnvironment(Environment):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_compile = None
+
+    # only called when jinja really compiles source, a template coming from
+    # the bytecode cache never gets here
+    def compile(self, source, name=None, filename=None, raw=False, defer_init=False):
+        start = time.perf_counter()
+        code = super().compile(source, name, filename, raw, defer_init)
+        if self.on_compile is not None and name is not None:
+            self.on_compile(name, time.perf_counter() - start)
+        return code
+
+
+# in production templates are compiled once at startup, compiled bytecode is
+# shared between workers through `cache_dir` and template files are never
+# stat()ed again
+class Templates:
+    def __init__(self, directory, mode="development", cache_dir=None, fragment_ttl=60,
+                 max_fragments=1024):
+        assert mode in TEMPLATE_MODES, f"Unknown templates mode '{mode}'"
+        self.mode = mode
+
+        options = {}
+        if mode == "production":
+            options["auto_reload"] = False
+            options["cache_size"] = -1
+            if cache_dir is None:
+                options["bytecode_cache"] = FileSystemBytecodeCache()
+            else:
+                os.makedirs(cache_dir, exist_ok=True)
+                options["bytecode_cache"] = FileSystemBytecodeCache(cache_dir)
+
+        self.env = TimedEnvironment(loader=FileSystemLoader(os.path.abspath(directory)), **options)
+        self.env.on_compile = self._record_compile
+        self.fragments = LRUCache(max_entries=max_fragments, ttl=fragment_ttl)
+        self._stats = {}
+        self._lock = threading.Lock()
+
+        if mode == "production":
+            self.precompile()
+
+    def precompile(self):
+        if not os.path.isdir(self.env.loader.searchpath[0]):
+            return []
+        names = self.env.list_templates()
+        for name in names:
+            self.env.get_template(name)
+        return names
+
+    def render(self, template_name, context=None, cache_key=None, ttl=None):
+        if context is None:
+            context = {}
+        if cache_key is not None:
+            return self.fragments.get_or_set(
+                (template_name, cache_key), lambda: self.render(template_name, context), ttl
+            )
+
+        template = self.env.get_template(template_name)
+        start = time.perf_counter()
+        rendered = template.render(**context)
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            stats = self._stats.get(template_name)
+            if stats is None:
+                stats = self._stats[template_name] = TemplateStats()
+            stats.renders += 1
+            stats.render_time += elapsed
+        return rendered
+
+    def stats(self):
+        with self._lock:
+            return {name: stats.as_dict() for name, stats in self._stats.items()}
+
+    def _record_compile(self, template_name, elapsed):
+        with self._lock:
+            stats = self._stats.get(template_name)
+            if stats is None:
+                stats = self._stats[template_name] = TemplateStats()
+            stats.compiles += 1
+            stats.compile_time += elapsed
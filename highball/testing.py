@@ -0,0 +1,259 @@
+import io
+import sys
+import json as jsonlib
+import threading
+from time import perf_counter
+from collections import Counter
+from http.cookies import SimpleCookie
+from urllib.parse import unquote, urlencode, urlsplit
+from wsgiref.util import FileWrapper
+
+DEFAULT_BASE_URL = "http://testserver"
+
+
+class Headers(dict):
+    def __init__(self, header_list=()):
+        super().__init__()
+        self.header_list = list(header_list)
+        for name, value in self.header_list:
+            key = name.lower()
+            # repeated headers are joined like requests does, Set-Cookie included
+            super().__setitem__(key, value if key not in self else f"{dict.__getitem__(self, key)}, {value}")
+
+    def __getitem__(self, name):
+        return super().__getitem__(name.lower())
+
+    def __contains__(self, name):
+        return super().__contains__(name.lower())
+
+    def get(self, name, default=None):
+        return super().get(name.lower(), default)
+
+    def getall(self, name):
+        name = name.lower()
+        return [value for key, value in self.header_list if key.lower() == name]
+
+
+class TestResponse:
+    __test__ = False
+
+    def __init__(self, status, header_list, content, url):
+        code, _, reason = status.partition(" ")
+        self.status_code = int(code)
+        self.reason = reason
+        self.headers = Headers(header_list)
+        self.content = content
+        self.url = url
+        self.cookies = {}
+        for header in self.headers.getall("Set-Cookie"):
+            for name, morsel in SimpleCookie(header).items():
+                self.cookies[name] = morsel.value
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def encoding(self):
+        _, _, charset = self.headers.get("Content-Type", "").partition("charset=")
+        return charset.split(";", 1)[0].strip() or "utf-8"
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, errors="replace")
+
+    def json(self):
+        return jsonlib.loads(self.content)
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise AssertionError(f"{self.status_code} {self.reason} for {self.url}")
+
+    def __repr__(self):
+        return f"<TestResponse [{self.status_code}]>"
+
+
+# calls the WSGI app directly with a hand built environ instead of going
+# through requests and an adapter, and keeps cookies between requests like a
+# requests.Session. exceptions raised by the app reach the test unchanged
+class TestClient:
+    __test__ = False
+
+    def __init__(self, app, base_url=DEFAULT_BASE_URL, headers=None):
+        self.app = app
+        self.base_url = base_url.rstrip("/")
+        self.headers = dict(headers or {})
+        self.cookies = {}
+
+    def build_environ(self, method, url, params=None, data=None, json=None, headers=None, cookies=None):
+        if url.startswith("/"):
+            url = self.base_url + url
+        parts = urlsplit(url)
+        query = parts.query
+        if params:
+            query = "&".join(filter(None, (query, urlencode(params, doseq=True))))
+
+        headers = {**self.headers, **(headers or {})}
+        body = b""
+        if json is not None:
+            body = jsonlib.dumps(json).encode("UTF-8")
+            headers.setdefault("Content-Type", "application/json")
+        elif isinstance(data, dict):
+            body = urlencode(data, doseq=True).encode("UTF-8")
+            headers.setdefault("Content-Type", "application/x-www-form-urlencoded")
+        elif data is not None:
+            body = data.encode("UTF-8") if isinstance(data, str) else data
+
+        cookies = {**self.cookies, **(cookies or {})}
+        if cookies and "Cookie" not in headers:
+            headers["Cookie"] = "; ".join(f"{name}={value}" for name, value in cookies.items())
+
+        scheme = parts.scheme or "http"
+        host, _, port = (parts.netloc or "testserver").partition(":")
+        environ = {
+            "REQUEST_METHOD": method.upper(),
+            "SCRIPT_NAME": "",
+            "PATH_INFO": unquote(parts.path or "/", encoding="latin1"),
+            "QUERY_STRING": query,
+            "SERVER_NAME": host,
+            "SERVER_PORT": port or ("443" if scheme == "https" else "80"),
+            "SERVER_PROTOCOL": "HTTP/1.1",
+            "REMOTE_ADDR": "127.0.0.1",
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scheme,
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+            "wsgi.file_wrapper": FileWrapper,
+        }
+        for name, value in headers.items():
+            key = name.upper().replace("-", "_")
+            if key in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                environ[key] = str(value)
+            else:
+                environ["HTTP_" + key] = str(value)
+        return environ
+
+    def request(self, method, url, **kwargs):
+        environ = self.build_environ(method, url, **kwargs)
+        started = {}
+
+        def start_response(status, header_list, exc_info=None):
+            started["status"] = status
+            started["headers"] = header_list
+
+        body = self.app(environ, start_response)
+        try:
+            content = b"".join(chunk.encode("latin1") if isinstance(chunk, str) else chunk for chunk in body)
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+
+        response = TestResponse(started["status"], started["headers"], content, url)
+        for header in response.headers.getall("Set-Cookie"):
+            for name, morsel in SimpleCookie(header).items():
+                if morsel["max-age"] == "0" or morsel.value == "":
+                    self.cookies.pop(name, None)
+                else:
+                    self.cookies[name] = morsel.value
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request("HEAD", url, **kwargs)
+
+    def options(self, url, **kwargs):
+        return self.request("OPTIONS", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request("PATCH", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    def load(self, method, url, total=1000, concurrency=8, check=None, **kwargs):
+        return load(self, method, url, total=total, concurrency=concurrency, check=check, **kwargs)
+
+
+class LoadResult:
+    def __init__(self, total, concurrency, elapsed, latencies, statuses, failures):
+        self.total = total
+        self.concurrency = concurrency
+        self.elapsed = elapsed
+        self.latencies = sorted(latencies)
+        self.statuses = statuses
+        self.failures = failures
+
+    @property
+    def throughput(self):
+        return len(self.latencies) / self.elapsed if self.elapsed else 0.0
+
+    def percentile(self, percent):
+        if not self.latencies:
+            return 0.0
+        index = min(len(self.latencies) - 1, int(len(self.latencies) * percent / 100))
+        return self.latencies[index]
+
+    def __repr__(self):
+        return (
+            f"<LoadResult {self.total} requests x{self.concurrency}: {self.throughput:.0f} req/s, "
+            f"p50 {self.percentile(50) * 1000:.2f}ms, p99 {self.percentile(99) * 1000:.2f}ms, "
+            f"{len(self.failures)} failures>"
+        )
+
+
+# fires `total` requests at the app from `concurrency` threads that all start
+# together behind a barrier, so shared state gets hit as hard as it can be
+# in-process. exceptions, 5xx responses and responses `check` rejects (by
+# returning False or raising) are collected as failures instead of stopping
+def load(client, method, url, total=1000, concurrency=8, check=None, **kwargs):
+    if not isinstance(client, TestClient):
+        client = TestClient(client)
+    barrier = threading.Barrier(concurrency + 1)
+    lock = threading.Lock()
+    remaining = [total]
+    latencies, statuses, failures = [], Counter(), []
+
+    def worker():
+        own_latencies, own_statuses, own_failures = [], Counter(), []
+        barrier.wait()
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    break
+                remaining[0] -= 1
+            started = perf_counter()
+            try:
+                # a fresh client per request keeps cookies out of the picture
+                response = TestClient(client.app, client.base_url, client.headers).request(method, url, **kwargs)
+                own_statuses[response.status_code] += 1
+                if response.status_code >= 500 or (check is not None and check(response) is False):
+                    own_failures.append(response)
+            except Exception as e:
+                own_statuses["exception"] += 1
+                own_failures.append(e)
+            own_latencies.append(perf_counter() - started)
+        with lock:
+            latencies.extend(own_latencies)
+            statuses.update(own_statuses)
+            failures.extend(own_failures)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    started = perf_counter()
+    for thread in threads:
+        thread.join()
+    return LoadResult(total, concurrency, perf_counter() - started, latencies, statuses, failures)
@@ -17,7 +17,6 @@ VERSION = "0.0.3"
 # Which packages are required for this module to be executed?
 REQUIRED = [
     "Jinja2==2.10.3",
-    "parse==1.12.1",
     "requests==2.22.0",
     "requests-wsgi-adapter==0.4.1",
     "WebOb==1.8.5",
@@ -56,7 +55,7 @@ setup(
     author=AUTHOR,
     author_email=EMAIL,
     python_requires=REQUIRES_PYTHON,
-    packages=find_packages(exclude=["test_*"]),
+    packages=find_packages(exclude=["test_*", "benchmarks"]),
     install_requires=REQUIRED,
     include_package_data=True,
     license="MIT",
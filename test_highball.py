@@ -1,7 +1,14 @@
+import asyncio
+import time
+import gzip
+import json
 import pytest
+from wsgiref.util import FileWrapper
+from types import SimpleNamespace
 
 from highball.api import API
 from highball.middleware import Middleware
+from highball.response import Response
 
 FILE_DIR = "css"
 FILE_NAME = "main.css"
@@ -15,6 +22,27 @@ def _create_static(static_dir):
     
     return asset
 
+def _asgi_request(app, method, path, body=b"", headers=()):
+    scope = {
+        "type": "http", "method": method, "path": path, "query_string": b"",
+        "headers": [(name.lower().encode(), value.encode()) for name, value in headers],
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = []
+    
+    async def receive():
+        return messages.pop(0)
+    
+    async def send(message):
+        sent.append(message)
+    
+    asyncio.run(app(scope, receive, send))
+    
+    status = sent[0]["status"]
+    headers = {name.decode(): value.decode() for name, value in sent[0]["headers"]}
+    body = b"".join(message.get("body", b"") for message in sent[1:])
+    return status, headers, body
+
 # tests
 
 def test_basic_route_adding(api):
@@ -81,8 +109,10 @@ def test_class_based_handler_not_allowed_method(api, client):
         def post(self, req, resp):
             resp.text = "yolo"
     
-    with pytest.raises(AttributeError):
-        client.get("http://testserver/book")
+    resp = client.get("http://testserver/book")
+    
+    assert resp.status_code == 405
+    assert resp.headers["Allow"] == "POST"
         
 def test_alternative_route(api, client):
     resp_text = "Alternative way to add a route"
@@ -165,9 +195,10 @@ def test_allowed_methods_for_function_based_handlers(api, client):
     def home(req, resp):
         resp.text = "Hello"
         
-    with pytest.raises(AttributeError):
-        client.get("http://testserver/home")
-        
+    resp = client.get("http://testserver/home")
+    
+    assert resp.status_code == 405
+    assert resp.headers["Allow"] == "POST"
     assert client.post("http://testserver/home").text == "Hello"
     
 def test_json_response_helper(api, client):
@@ -216,4 +247,710 @@ def text_manually_setting_body(api, client):
     response = client.get("http://testserver/body")
     
     assert "text/plain" in response.headers["Content-Type"]
-    assert response.text == "Byte Body"
\ No newline at end of file
+    assert response.text == "Byte Body"
+
+def test_typed_route_parameters(api, client):
+    @api.route("/book/{id:d}")
+    def book(req, resp, id):
+        resp.text = f"{type(id).__name__} {id}"
+
+    @api.route("/book/{slug}")
+    def book_by_slug(req, resp, slug):
+        resp.text = f"slug {slug}"
+
+    assert client.get("http://testserver/book/42").text == "int 42"
+    assert client.get("http://testserver/book/highball").text == "slug highball"
+    
+def test_static_route_wins_over_parameterized_route(api, client):
+    @api.route("/book/{name}")
+    def book(req, resp, name):
+        resp.text = name
+
+    @api.route("/book/new")
+    def new_book(req, resp):
+        resp.text = "new"
+
+    assert client.get("http://testserver/book/new").text == "new"
+    assert client.get("http://testserver/book/old").text == "old"
+    assert client.get("http://testserver/book/old/pages").status_code == 404
+    
+def test_ambiguous_route_throws_exception(api):
+    @api.route("/book/{id}")
+    def book(req, resp, id):
+        resp.text = id
+
+    with pytest.raises(AssertionError):
+        @api.route("/book/{name}")
+        def book2(req, resp, name):
+            resp.text = name
+            
+def test_path_route_parameter(api, client):
+    @api.route("/files/{name}.{ext}")
+    def file(req, resp, name, ext):
+        resp.text = f"{name} {ext}"
+
+    @api.route("/files/{rest:path}")
+    def files(req, resp, rest):
+        resp.text = rest
+
+    assert client.get("http://testserver/files/main.css").text == "main css"
+    assert client.get("http://testserver/files/css/main.css").text == "css/main.css"
+
+def test_class_based_handler_instance_modes(api, client):
+    created = []
+    
+    class BookResource:
+        def __init__(self):
+            created.append(self)
+            
+        def get(self, req, resp):
+            resp.text = str(len(created))
+            
+    api.add_route("/per-request", BookResource)
+    api.add_route("/shared", BookResource, instance="shared")
+    
+    assert len(created) == 1
+    assert client.get("http://testserver/shared").text == "1"
+    assert client.get("http://testserver/shared").text == "1"
+    assert client.get("http://testserver/per-request").text == "2"
+    assert client.get("http://testserver/per-request").text == "3"
+
+def test_asgi_async_and_sync_handlers(api):
+    @api.route("/async")
+    async def async_handler(req, resp):
+        await asyncio.sleep(0)
+        resp.text = "async"
+        
+    @api.route("/sync")
+    def sync_handler(req, resp):
+        resp.text = "sync"
+        
+    @api.route("/book")
+    class BookResource:
+        async def get(self, req, resp):
+            resp.json = {"method": req.method}
+            
+    assert _asgi_request(api, "GET", "/async")[2] == b"async"
+    assert _asgi_request(api, "GET", "/sync")[2] == b"sync"
+    
+    status, headers, body = _asgi_request(api, "GET", "/book")
+    assert status == 200
+    assert headers["content-type"] == "application/json"
+    assert b"GET" in body
+    
+    status, headers, _ = _asgi_request(api, "POST", "/book")
+    assert status == 405
+    assert headers["allow"] == "GET"
+    assert _asgi_request(api, "GET", "/nothing")[0] == 404
+    
+def test_async_handler_under_wsgi(api, client):
+    @api.route("/async")
+    async def async_handler(req, resp):
+        resp.text = "async"
+        
+    assert client.get("http://testserver/async").text == "async"
+    
+def test_asgi_runs_middleware_and_exception_handler(api):
+    calls = []
+    
+    class RecordingMiddleware(Middleware):
+        def process_request(self, req):
+            calls.append("request")
+            
+        def process_response(self, req, resp):
+            calls.append("response")
+            
+    api.add_middleware(RecordingMiddleware)
+    api.add_exception_handler(lambda req, resp, exc: setattr(resp, "text", "handled"))
+    
+    @api.route("/")
+    async def index(req, resp):
+        raise AttributeError()
+        
+    assert _asgi_request(api, "GET", "/")[2] == b"handled"
+    assert calls == ["request", "response"]
+    
+def test_asgi_serves_assets(tmpdir_factory):
+    static_dir = tmpdir_factory.mktemp("static")
+    _create_static(static_dir=static_dir)
+    api = API(static_dir=str(static_dir))
+    
+    status, _, body = _asgi_request(api, "GET", f"/static/{FILE_DIR}/{FILE_NAME}")
+    
+    assert status == 200
+    assert body.decode() == FILE_CONTENTS
+
+def test_streaming_response(api, client):
+    @api.route("/export")
+    def export(req, resp):
+        resp.content_type = "text/csv"
+        resp.stream = (f"{i},row{i}\n" for i in range(3))
+        
+    response = client.get("http://testserver/export")
+    
+    assert response.headers["Content-Type"] == "text/csv; charset=UTF-8"
+    assert "Content-Length" not in response.headers
+    assert response.text == "0,row0\n1,row1\n2,row2\n"
+    assert _asgi_request(api, "GET", "/export")[2] == b"0,row0\n1,row1\n2,row2\n"
+    
+def test_file_response_and_ranges(api, client, tmpdir):
+    asset = tmpdir.join("data.txt")
+    asset.write("0123456789")
+    
+    @api.route("/download")
+    def download(req, resp):
+        resp.file = str(asset)
+        
+    response = client.get("http://testserver/download")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == "text/plain; charset=UTF-8"
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert response.text == "0123456789"
+    
+    response = client.get("http://testserver/download", headers={"Range": "bytes=2-5"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == "bytes 2-5/10"
+    assert response.text == "2345"
+    
+    assert client.get("http://testserver/download", headers={"Range": "bytes=-3"}).text == "789"
+    assert client.get("http://testserver/download", headers={"Range": "bytes=20-"}).status_code == 416
+    
+def test_file_response_uses_file_wrapper(api, tmpdir):
+    asset = tmpdir.join("data.txt")
+    asset.write("0123456789")
+    
+    @api.route("/download")
+    def download(req, resp):
+        resp.file = str(asset)
+        
+    environ = {"REQUEST_METHOD": "GET", "PATH_INFO": "/download", "wsgi.file_wrapper": FileWrapper}
+    body = api(environ, lambda status, headers: None)
+    
+    assert isinstance(body, FileWrapper)
+    assert b"".join(body) == b"0123456789"
+    body.close()
+
+def test_response_headers_and_cookies(api, client):
+    @api.route("/cookies")
+    def cookies(req, resp):
+        resp.text = "cookies"
+        resp.headers["X-Powered-By"] = "highball"
+        resp.set_cookie("session", "abc", max_age=60, httponly=True)
+        resp.delete_cookie("old")
+        
+    response = client.get("http://testserver/cookies")
+    
+    assert response.headers["X-Powered-By"] == "highball"
+    assert response.headers["Content-Length"] == "7"
+    assert response.cookies["session"] == "abc"
+    assert "HttpOnly" in response.headers["Set-Cookie"]
+    assert "old=" in response.headers["Set-Cookie"]
+    
+def test_json_encoder_hook():
+    from datetime import date
+    from highball.response import json_encoder
+    
+    api = API(json_encoder=json_encoder(default=lambda value: value.isoformat()))
+    client = api.test_session()
+    
+    @api.route("/date")
+    def today(req, resp):
+        resp.json = {"day": date(2020, 1, 2)}
+        
+    @api.route("/raw")
+    def raw(req, resp):
+        resp.json = b'{"cached":true}'
+        
+    assert client.get("http://testserver/date").text == '{"day":"2020-01-02"}'
+    
+    @api.route("/string")
+    def string(req, resp):
+        resp.json = "hello"
+        
+    response = client.get("http://testserver/raw")
+    assert response.headers["Content-Type"] == "application/json"
+    assert response.json() == {"cached": True}
+    assert client.get("http://testserver/string").text == '"hello"'
+
+def test_request_parses_query_headers_cookies_and_body(api, client):
+    seen = {}
+    
+    @api.route("/echo")
+    def echo(req, resp):
+        seen["url"] = req.url
+        seen["q"] = req.params["q"]
+        seen["tags"] = req.GET.getall("tag")
+        seen["agent"] = req.headers["user-agent"]
+        seen["session"] = req.cookies.get("session")
+        seen["json"] = req.json
+        resp.text = req.method
+        
+    response = client.post(
+        "http://testserver/echo?q=books&tag=a&tag=b",
+        json={"title": "ORM"},
+        headers={"User-Agent": "tests", "Cookie": "session=abc"},
+    )
+    
+    assert response.text == "POST"
+    assert seen == {
+        "url": "http://testserver/echo?q=books&tag=a&tag=b",
+        "q": "books",
+        "tags": ["a", "b"],
+        "agent": "tests",
+        "session": "abc",
+        "json": {"title": "ORM"},
+    }
+    
+def test_request_form_params(api, client):
+    @api.route("/form")
+    def form(req, resp):
+        resp.text = f"{req.params['name']} {req.POST['age']}"
+        
+    assert client.post("http://testserver/form", data={"name": "gyu", "age": "30"}).text == "gyu 30"
+
+def test_middleware_order_and_short_circuit(api, client):
+    calls = []
+    
+    class Outer(Middleware):
+        def process_request(self, req):
+            calls.append("outer request")
+            
+        def process_response(self, req, resp):
+            calls.append("outer response")
+            
+    class Auth(Middleware):
+        def process_request(self, req):
+            calls.append("auth request")
+            if "Authorization" not in req.headers:
+                response = Response()
+                response.status_code = 401
+                response.text = "Unauthorized"
+                return response
+            
+    class Inner(Middleware):
+        def process_response(self, req, resp):
+            calls.append("inner response")
+            
+    api.add_middleware(Inner)
+    api.add_middleware(Auth)
+    api.add_middleware(Outer)
+    
+    @api.route("/")
+    def index(req, resp):
+        calls.append("handler")
+        resp.text = "YOLO"
+        
+    response = client.get("http://testserver/")
+    assert response.status_code == 401
+    assert calls == ["outer request", "auth request", "outer response"]
+    
+    calls.clear()
+    response = client.get("http://testserver/", headers={"Authorization": "token"})
+    assert response.text == "YOLO"
+    assert calls == ["outer request", "auth request", "handler", "inner response", "outer response"]
+    
+    request_hooks, response_hooks = api.middleware.compile()
+    assert len(request_hooks) == 2
+    assert len(response_hooks) == 2
+
+def test_middleware_overriding_handle_request_wraps_the_rest(api, client):
+    calls = []
+    
+    class Timing(Middleware):
+        def handle_request(self, request):
+            calls.append("timing before")
+            response = self.app.handle_request(request)
+            response.headers["X-Timing"] = "1ms"
+            calls.append("timing after")
+            return response
+            
+    class Inner(Middleware):
+        def process_request(self, req):
+            calls.append("inner request")
+            
+        def process_response(self, req, resp):
+            calls.append("inner response")
+            
+    api.add_middleware(Inner)
+    api.add_middleware(Timing)
+    
+    @api.route("/")
+    def index(req, resp):
+        calls.append("handler")
+        resp.text = "YOLO"
+        
+    response = client.get("http://testserver/")
+    assert response.headers["X-Timing"] == "1ms"
+    assert calls == ["timing before", "inner request", "handler", "inner response", "timing after"]
+    
+    calls.clear()
+    status, headers, body = _asgi_request(api, "GET", "/")
+    assert status == 200 and headers["x-timing"] == "1ms"
+    assert calls == ["timing before", "inner request", "handler", "inner response", "timing after"]
+
+def test_production_templates_are_precompiled(tmpdir):
+    templates_dir = tmpdir.mkdir("templates")
+    templates_dir.join("hello.html").write("Hello {{ name }}")
+    api = API(templates_dir=str(templates_dir), templates_mode="production",
+              templates_cache_dir=str(tmpdir.join("bytecode")))
+    
+    templates_dir.join("hello.html").write("Changed {{ name }}")
+    
+    assert api.template("hello.html", context={"name": "gyu"}) == "Hello gyu"
+    assert tmpdir.join("bytecode").listdir()
+    
+    stats = api.templates.stats()["hello.html"]
+    assert stats["compiles"] == 1
+    assert stats["renders"] == 1
+    
+def test_template_fragment_cache(tmpdir):
+    templates_dir = tmpdir.mkdir("templates")
+    templates_dir.join("sidebar.html").write("{{ items|length }} items")
+    api = API(templates_dir=str(templates_dir))
+    
+    assert api.template("sidebar.html", {"items": [1, 2]}, cache_key="sidebar") == "2 items"
+    assert api.template("sidebar.html", {"items": [1, 2, 3]}, cache_key="sidebar") == "2 items"
+    
+    api.templates.fragments.invalidate(("sidebar.html", "sidebar"))
+    assert api.template("sidebar.html", {"items": [1, 2, 3]}, cache_key="sidebar") == "3 items"
+    assert api.templates.stats()["sidebar.html"]["renders"] == 2
+    
+    api.templates.fragments.invalidate()
+    assert len(api.templates.fragments) == 0
+
+def test_cache_middleware_serves_cached_responses_and_304s(api, client):
+    from highball.cache import CacheMiddleware, never_cache
+    
+    calls = []
+    cache = api.add_middleware(CacheMiddleware, ttl=60)
+    
+    @api.route("/books")
+    def books(req, resp):
+        calls.append("books")
+        resp.json = {"books": len(calls)}
+        
+    @api.route("/random")
+    @never_cache
+    def random(req, resp):
+        calls.append("random")
+        resp.text = "random"
+        
+    first = client.get("http://testserver/books")
+    second = client.get("http://testserver/books")
+    assert calls == ["books"]
+    assert first.json() == second.json() == {"books": 1}
+    
+    etag = first.headers["ETag"]
+    assert second.headers["ETag"] == etag
+    
+    not_modified = client.get("http://testserver/books", headers={"If-None-Match": etag})
+    assert not_modified.status_code == 304
+    assert not_modified.content == b""
+    
+    not_modified = client.get("http://testserver/books", headers={"If-Modified-Since": first.headers["Last-Modified"]})
+    assert not_modified.status_code == 304
+    
+    assert client.get("http://testserver/books?page=2").json() == {"books": 2}
+    
+    client.get("http://testserver/random")
+    random_response = client.get("http://testserver/random", headers={"If-None-Match": '"nope"'})
+    assert calls.count("random") == 2
+    assert random_response.status_code == 200
+    
+    assert cache.invalidate(prefix="/books") == 2
+    assert client.get("http://testserver/books").json() == {"books": 5}
+
+def test_cache_middleware_around_a_nested_middleware(api, client):
+    from highball.cache import CacheMiddleware
+    
+    class Custom(Middleware):
+        def handle_request(self, request):
+            response = self.app.handle_request(request)
+            response.headers["X-Custom"] = "yes"
+            return response
+    
+    calls = []
+    api.add_middleware(Custom)
+    api.add_middleware(CacheMiddleware, ttl=60)
+    
+    @api.route("/books")
+    def books(req, resp):
+        calls.append("books")
+        resp.json = {"books": len(calls)}
+        
+    first = client.get("http://testserver/books")
+    second = client.get("http://testserver/books")
+    assert first.json() == second.json() == {"books": 1}
+    assert first.headers["X-Custom"] == "yes"
+    assert calls == ["books"]
+
+def test_changes_after_the_cache_encoded_the_body_are_sent(api, client):
+    from highball.cache import CacheMiddleware
+    
+    class Versioned(Middleware):
+        def process_response(self, req, resp):
+            resp.json["version"] = 2
+    
+    api.add_middleware(CacheMiddleware, ttl=60)
+    api.add_middleware(Versioned)
+    
+    @api.route("/data")
+    def data(req, resp):
+        resp.json = {"a": 1}
+        
+    assert client.get("http://testserver/data").json() == {"a": 1, "version": 2}
+
+def test_compression_middleware(api, client):
+    from highball.compression import CompressionMiddleware
+    
+    compression = api.add_middleware(CompressionMiddleware, min_size=100, levels={"application/json": 1})
+    
+    @api.route("/big")
+    def big(req, resp):
+        resp.json = {"items": ["book"] * 100}
+        
+    @api.route("/small")
+    def small(req, resp):
+        resp.text = "tiny"
+        
+    @api.route("/stream")
+    def stream(req, resp):
+        resp.content_type = "text/csv"
+        resp.stream = ("row,%d\n" % i for i in range(100))
+        
+    response = client.get("http://testserver/big", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert int(response.headers["Content-Length"]) < 100
+    assert json.loads(gzip.decompress(response.content)) == {"items": ["book"] * 100}
+    
+    client.get("http://testserver/big", headers={"Accept-Encoding": "gzip"})
+    assert compression.cache.stats()["hits"] == 1
+    
+    assert "Content-Encoding" not in client.get("http://testserver/big", headers={"Accept-Encoding": "identity"}).headers
+    assert "Content-Encoding" not in client.get("http://testserver/small", headers={"Accept-Encoding": "gzip"}).headers
+    
+    response = client.get("http://testserver/stream", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(response.content).decode().splitlines()[99] == "row,99"
+
+def test_cache_middleware_varies_and_skips_credentialed_requests(api, client):
+    from highball.cache import CacheMiddleware, cached
+    from highball.compression import CompressionMiddleware
+    
+    calls = []
+    api.add_middleware(CompressionMiddleware, min_size=100)
+    api.add_middleware(CacheMiddleware, ttl=60)
+    
+    @api.route("/big")
+    def big(req, resp):
+        calls.append("big")
+        resp.json = {"items": ["book"] * 100}
+        
+    @api.route("/public")
+    @cached(60)
+    def public(req, resp):
+        calls.append("public")
+        resp.text = "public"
+        
+    assert client.get("http://testserver/big", headers={"Accept-Encoding": "gzip"}).headers["Content-Encoding"] == "gzip"
+    plain = client.get("http://testserver/big", headers={"Accept-Encoding": "identity"})
+    assert "Content-Encoding" not in plain.headers
+    assert plain.json() == {"items": ["book"] * 100}
+    assert client.get("http://testserver/big", headers={"Accept-Encoding": "gzip"}).headers["Content-Encoding"] == "gzip"
+    assert calls == ["big", "big"]
+    
+    client.get("http://testserver/big", headers={"Cookie": "session=abc"})
+    client.get("http://testserver/big", headers={"Cookie": "session=abc"})
+    assert calls.count("big") == 4
+    
+    client.get("http://testserver/public", headers={"Authorization": "Bearer abc"})
+    client.get("http://testserver/public", headers={"Authorization": "Bearer abc"})
+    assert calls.count("public") == 1
+
+def test_static_build_serves_hashed_and_compressed_assets(tmpdir_factory):
+    static_dir = tmpdir_factory.mktemp("static")
+    asset = _create_static(static_dir=static_dir)
+    asset.write(FILE_CONTENTS * 20)
+    build_dir = tmpdir_factory.mktemp("build")
+    templates_dir = tmpdir_factory.mktemp("templates")
+    templates_dir.join("page.html").write('{{ static("css/main.css") }}')
+    
+    api = API(static_dir=str(static_dir), static_build_dir=str(build_dir), templates_dir=str(templates_dir))
+    client = api.test_session()
+    
+    hashed_url = api.template("page.html")
+    assert hashed_url.startswith("/static/css/main.") and hashed_url != "/static/css/main.css"
+    assert build_dir.join("staticfiles.json").check()
+    assert build_dir.join(hashed_url[len("/static/"):] + ".gz").check()
+    
+    response = client.get(f"http://testserver{hashed_url}", headers={"Accept-Encoding": "identity"})
+    assert response.status_code == 200
+    assert "immutable" in response.headers["Cache-Control"]
+    assert response.text == FILE_CONTENTS * 20
+    
+    response = client.get(f"http://testserver{hashed_url}", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    
+    response = client.get(f"http://testserver/static/{FILE_DIR}/{FILE_NAME}")
+    assert "immutable" not in response.headers["Cache-Control"]
+    
+def test_mounted_wsgi_app(api, client):
+    def legacy_app(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [f"{environ['SCRIPT_NAME']} {environ['PATH_INFO']}".encode()]
+    
+    api.mount("/legacy", legacy_app)
+    
+    @api.route("/legacyish")
+    def legacyish(req, resp):
+        resp.text = "route"
+        
+    assert client.get("http://testserver/legacy/users/1").text == "/legacy /users/1"
+    assert client.get("http://testserver/legacyish").text == "route"
+
+def test_metrics_endpoint(api, client):
+    api.enable_metrics()
+    api.add_exception_handler(lambda req, resp, exc: setattr(resp, "text", "oops"))
+    
+    @api.route("/book/{id:d}")
+    def book(req, resp, id):
+        if id == 0:
+            raise ValueError("no book")
+        resp.text = "book"
+        
+    client.get("http://testserver/book/1")
+    client.get("http://testserver/book/2")
+    client.get("http://testserver/book/0")
+    client.get("http://testserver/nothing")
+    
+    response = client.get("http://testserver/metrics")
+    metrics = response.text
+    
+    assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    assert 'highball_requests_total{route="/book/{id:d}",method="GET",status="200"} 3' in metrics
+    assert 'highball_requests_total{route="<unmatched>",method="GET",status="404"} 1' in metrics
+    assert 'highball_exceptions_total{route="/book/{id:d}",exception="ValueError"} 1' in metrics
+    assert 'highball_request_duration_seconds_count{route="/book/{id:d}",phase="handler"} 3' in metrics
+    assert 'highball_request_duration_seconds_bucket{route="/book/{id:d}",phase="total",le="+Inf"} 3' in metrics
+    assert 'phase="routing"' in metrics and 'phase="serialization"' in metrics
+
+def test_profiling_signed_header_and_sampling(api, client, tmpdir):
+    import pstats
+    
+    profiler = api.enable_profiling(str(tmpdir), secret="s3cret")
+    
+    @api.route("/slow/{id:d}")
+    def slow(req, resp, id):
+        time.sleep(0.02)
+        resp.text = "slow"
+        
+    client.get("http://testserver/slow/1")
+    client.get("http://testserver/slow/1", headers={"X-Highball-Profile": "forged"})
+    assert tmpdir.listdir() == []
+    
+    client.get("http://testserver/slow/1", headers={"X-Highball-Profile": "é"})
+    client.get("http://testserver/slow/1", headers={"X-Highball-Profile": profiler.sign("/slow/1", now=time.time() - 7200)})
+    client.get("http://testserver/slow/1", headers={"X-Highball-Profile": profiler.sign("/slow/2")})
+    assert tmpdir.listdir() == []
+    
+    client.get("http://testserver/slow/1", headers={"X-Highball-Profile": profiler.sign("/slow/1")})
+    [profile] = tmpdir.listdir()
+    assert "-GET-slow_id_d-" in profile.basename and profile.ext == ".prof"
+    assert pstats.Stats(str(profile)).total_calls > 0
+    
+    profile.remove()
+    api.enable_profiling(str(tmpdir), sample_rate=1.0, mode="sampling")
+    client.get("http://testserver/slow/1")
+    [collapsed] = tmpdir.listdir()
+    assert collapsed.basename.endswith(".collapsed")
+    assert "slow (test_highball.py" in collapsed.read()
+    
+def test_profiling_under_asgi_profiles_the_handler_thread(api, tmpdir):
+    import pstats
+    
+    profiler = api.enable_profiling(str(tmpdir), secret="s3cret")
+    
+    def render_page():
+        time.sleep(0.01)
+        return "slow"
+    
+    @api.route("/slow")
+    def slow(req, resp):
+        resp.text = render_page()
+        
+    status, _, body = _asgi_request(api, "GET", "/slow", headers=[("X-Highball-Profile", profiler.sign("/slow"))])
+    assert (status, body) == (200, b"slow")
+    [profile] = tmpdir.listdir()
+    assert any(name == "render_page" for _, _, name in pstats.Stats(str(profile)).stats)
+    
+    # only one request is profiled at a time
+    profile.remove()
+    active = profiler.begin()
+    assert _asgi_request(api, "GET", "/slow", headers=[("X-Highball-Profile", profiler.sign("/slow"))])[2] == b"slow"
+    assert tmpdir.listdir() == []
+    profiler.stop(active, SimpleNamespace(method="GET"), "/slow")
+    assert len(tmpdir.listdir()) == 1
+    
+def test_slow_request_log_records_sql(api, client, db, Author):
+    slow_log = api.enable_slow_request_log(threshold=0.0)
+    db.create(Author)
+    
+    @api.route("/authors")
+    def authors(req, resp):
+        db.save(Author(name="John Doe", age=23))
+        resp.text = str(len(db.all(Author)))
+        
+    assert client.get("http://testserver/authors").text == "1"
+    
+    [entry] = slow_log.entries
+    assert entry["route"] == "/authors"
+    assert entry["status"] == 200
+    assert {"middleware", "handler", "serialization", "total"} <= set(entry["timings"])
+    assert any(query.startswith("INSERT INTO author") for query in entry["queries"])
+    assert any(query.startswith("SELECT id, age, name FROM author") for query in entry["queries"])
+
+def test_test_client_keeps_cookies_and_sends_query_params(api, client):
+    @api.route("/login")
+    def login(req, resp):
+        resp.set_cookie("session", "abc")
+        resp.text = "ok"
+
+    @api.route("/whoami")
+    def whoami(req, resp):
+        resp.json = {"session": req.cookies.get("session"), "page": req.params.get("page")}
+
+    @api.route("/logout")
+    def logout(req, resp):
+        resp.delete_cookie("session")
+
+    assert client.get("/login").cookies == {"session": "abc"}
+    assert client.get("/whoami", params={"page": 2}).json() == {"session": "abc", "page": "2"}
+    client.get("/logout")
+    assert client.get("http://testserver/whoami").json() == {"session": None, "page": None}
+
+def test_load_driver_reports_throughput_and_failures(api, client):
+    counter = {"value": 0}
+
+    @api.route("/count")
+    def count(req, resp):
+        value = counter["value"]
+        time.sleep(0)
+        counter["value"] = value + 1
+        resp.text = str(value)
+
+    @api.route("/boom")
+    def boom(req, resp):
+        raise RuntimeError("boom")
+
+    result = client.load("GET", "/count", total=200, concurrency=4)
+    assert result.statuses[200] == 200
+    assert len(result.latencies) == 200 and result.throughput > 0
+    assert result.percentile(50) <= result.percentile(99)
+
+    result = client.load("GET", "/boom", total=10, concurrency=2)
+    assert result.statuses["exception"] == 10
+    assert all(isinstance(failure, RuntimeError) for failure in result.failures)
+
+    result = client.load("GET", "/count", total=20, concurrency=2, check=lambda response: response.text == "-1")
+    assert len(result.failures) == 20
@@ -1,5 +1,6 @@
 import pytest
 import sqlite3
+import json
 
 def test_create_db(db):
     assert isinstance(db.conn, sqlite3.Connection)
@@ -150,4 +151,491 @@ def test_delete_author(db, Author):
     
     with pytest.raises(Exception):
         db.get(Author, 1)
-    
\ No newline at end of file
+        
+def test_connections_are_per_thread_and_pooled(tmpdir, Author):
+    import threading
+    from highball.orm import Database, PoolTimeout
+    
+    db = Database(str(tmpdir.join("pool.db")), pool_size=2, timeout=5.0, pragmas={"cache_size": -2000})
+    db.create(Author)
+    assert db.conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert db.conn.execute("PRAGMA cache_size").fetchone()[0] == -2000
+    db.release()
+    
+    # more threads than connections, none of them hands its connection back
+    errors = []
+    def worker():
+        try:
+            db.save(Author(name="John Doe", age=23))
+        except PoolTimeout as e:
+            errors.append(e)
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+        
+    assert errors == []
+    assert db.pool.size <= 2 and db.pool.idle == db.pool.size
+    assert len(db.all(Author)) == 8
+    
+    with db.connection() as conn:
+        assert db.conn is conn
+        with db.connection():
+            with pytest.raises(PoolTimeout):
+                db.pool.acquire(timeout=0.05)
+    assert db.pool.idle == 2
+    db.close()
+    
+def test_memory_database_is_shared_between_threads(Author):
+    import threading
+    from highball.orm import Database
+    
+    db = Database(":memory:")
+    db.create(Author)
+    thread = threading.Thread(target=lambda: db.save(Author(name="John Doe", age=23)))
+    thread.start()
+    thread.join()
+    
+    assert db.get(Author, id=1).name == "John Doe"
+    
+def test_connection_middleware_returns_connections(tmpdir, Author):
+    from highball.api import API
+    from highball.orm import ConnectionMiddleware, Database
+    
+    db = Database(str(tmpdir.join("requests.db")), pool_size=1)
+    db.create(Author)
+    db.release()
+    
+    api = API()
+    api.add_middleware(ConnectionMiddleware, db=db)
+    
+    @api.route("/authors")
+    def authors(req, resp):
+        db.save(Author(name="John Doe", age=23))
+        resp.json = {"authors": len(db.all(Author)), "idle": db.pool.idle}
+    
+    client = api.test_client()
+    assert client.get("/authors").json() == {"authors": 1, "idle": 0}
+    assert client.get("/authors").json() == {"authors": 2, "idle": 0}
+    assert db.pool.idle == 1
+    
+def test_connection_middleware_waits_off_the_event_loop(tmpdir, Author):
+    import asyncio
+    import threading
+    from highball.api import API
+    from highball.orm import ConnectionMiddleware, Database
+    
+    db = Database(str(tmpdir.join("requests.db")), pool_size=1)
+    db.create(Author)
+    
+    api = API()
+    api.add_middleware(ConnectionMiddleware, db=db)
+    
+    @api.route("/authors")
+    def authors(req, resp):
+        resp.json = {"authors": len(db.all(Author))}
+    
+    async def main():
+        held = db.pool.acquire()
+        threading.Timer(0.1, db.pool.release, [held]).start()
+        ticks = 0
+        async def tick():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+        ticker = asyncio.create_task(tick())
+        sent = []
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+        async def send(message):
+            sent.append(message)
+        scope = {"type": "http", "method": "GET", "path": "/authors", "query_string": b"", "headers": []}
+        await api(scope, receive, send)
+        ticker.cancel()
+        return sent, ticks
+    
+    sent, ticks = asyncio.run(main())
+    assert sent[0]["status"] == 200
+    assert ticks >= 5
+    assert db.pool.idle == 1
+    
+def test_lease_that_fails_to_acquire_is_quiet(tmpdir, capsys):
+    import gc
+    from highball.orm import ConnectionPool, PoolTimeout, _Lease
+    
+    pool = ConnectionPool(str(tmpdir.join("lease.db")), max_size=1)
+    held = pool.acquire()
+    with pytest.raises(PoolTimeout):
+        _Lease(pool, timeout=0)
+    gc.collect()
+    assert capsys.readouterr().err == ""
+    pool.release(held)
+    
+def test_save_many_assigns_ids_in_chunks(db, Author, Book):
+    db.create(Author)
+    db.create(Book)
+    arash = Author(name="Arash Kun", age=23)
+    db.save(arash)
+    
+    authors = [Author(name=f"Author {i}", age=i) for i in range(5)]
+    assert db.save_many(authors, chunk_size=2) == 5
+    assert [author.id for author in authors] == [2, 3, 4, 5, 6]
+    
+    books = (Book(title=f"Book {i}", published=True, author=arash) for i in range(3))
+    assert db.save_many(books) == 3
+    assert [book.title for book in db.all(Book)] == ["Book 0", "Book 1", "Book 2"]
+    assert db.get(Author, id=4).name == "Author 2"
+    
+    with pytest.raises(Exception):
+        db.save_many([Author(name="ok", age=1), Book(title="no author", published=False, author=None)])
+    assert len(db.all(Author)) == 6
+    
+def test_transaction_commits_once_and_rolls_back(db, Author):
+    db.create(Author)
+    
+    with db.transaction():
+        db.save(Author(name="John Doe", age=23))
+        db.save(Author(name="Jane Doe", age=25))
+        assert db.conn.in_transaction
+    assert not db.conn.in_transaction
+    assert len(db.all(Author)) == 2
+    
+    with pytest.raises(ValueError):
+        with db.transaction(immediate=True):
+            db.delete(Author, id=1)
+            raise ValueError()
+    assert len(db.all(Author)) == 2
+    
+    @db.transaction()
+    def rename(name):
+        john = db.get(Author, id=1)
+        john.name = name
+        db.update(john)
+        
+    rename("John Wick")
+    assert db.get(Author, id=1).name == "John Wick"
+    
+def test_nested_transactions_use_savepoints(db, Author):
+    db.create(Author)
+    
+    with db.transaction():
+        db.save(Author(name="John Doe", age=23))
+        try:
+            with db.transaction():
+                db.save(Author(name="Jane Doe", age=25))
+                db.save_many([Author(name="Jim Doe", age=27)])
+                raise ValueError()
+        except ValueError:
+            pass
+        with db.transaction():
+            db.save(Author(name="Jack Doe", age=29))
+            
+    assert [author.name for author in db.all(Author)] == ["John Doe", "Jack Doe"]
+    
+def _count_queries(db):
+    queries = []
+    db.conn.set_trace_callback(queries.append)
+    return queries
+    
+def test_foreign_keys_load_without_n_plus_one_queries(db, Author, Book):
+    db.create(Author)
+    db.create(Book)
+    john = Author(name="John Doe", age=43)
+    arash = Author(name="Arash Kun", age=50)
+    db.save_many([john, arash])
+    db.save_many(Book(title=f"Book {i}", published=True, author=[john, arash][i % 2]) for i in range(10))
+    
+    for related, expected in (("join", 1), ("prefetch", 2)):
+        queries = _count_queries(db)
+        books = db.all(Book, related=related)
+        assert len(queries) == expected
+        assert [book.author.name for book in books[:2]] == ["John Doe", "Arash Kun"]
+        assert books[0].author is books[2].author
+        
+    queries = _count_queries(db)
+    books = db.all(Book, related="lazy")
+    assert books[0].author.id == 1 and len(queries) == 1
+    assert books[0].author.name == "John Doe" and len(queries) == 2
+    assert books[2].author.name == "John Doe" and len(queries) == 2
+    
+    queries = _count_queries(db)
+    book = db.get(Book, id=2)
+    assert book.author.name == "Arash Kun" and len(queries) == 1
+    
+def test_session_identity_map(db, Author, Book):
+    db.create(Author)
+    db.create(Book)
+    john = Author(name="John Doe", age=43)
+    db.save(john)
+    db.save(Book(title="Building an ORM", published=False, author=john))
+    
+    assert db.get(Author, id=1) is not db.get(Author, id=1)
+    with db.session():
+        author = db.get(Author, id=1)
+        assert db.get(Author, id=1) is author
+        assert db.all(Book, related="join")[0].author is author
+        
+        db.delete(Author, id=1)
+        with pytest.raises(Exception):
+            db.get(Author, id=1)
+    
+def test_schema_is_built_once_per_class(db, Author):
+    from highball.orm import Column, Table
+    
+    class Publisher(Table):
+        name = Column(str)
+        external_id = Column(str)
+        
+    assert Publisher._schema.fields == ["id", "external_id", "name"]
+    assert Publisher._schema.insert_sql == "INSERT INTO publisher (external_id, name) VALUES (?, ?);"
+    assert Author(name="John", age=3, id=7)._get_update_sql() == (
+        "UPDATE author SET age = ?, name = ? WHERE id = ?", [3, "John", 7]
+    )
+    
+    db.create(Publisher)
+    db.save(Publisher(name="Penguin", external_id="p-1"))
+    assert db.get(Publisher, id=1).external_id == "p-1"
+    assert db.all(Publisher, related="lazy")[0].external_id == "p-1"
+    
+def test_rows_are_slotted(db, Author, Book):
+    john = Author(name="John Doe", age=23)
+    assert not hasattr(john, "__dict__")
+    assert Author.__slots__ == ("_name", "_age")
+    assert Author(name="Jane Doe").age is None
+    
+    john.age = 24
+    assert john.age == 24 and john._get_insert_sql()[1] == [24, "John Doe"]
+    
+    with pytest.raises(TypeError):
+        Author(nickname="JD")
+    with pytest.raises(AttributeError):
+        john.nickname = "JD"
+        
+    db.create(Author)
+    db.save(john)
+    assert repr(db.get(Author, id=1)) == "<Author id=1>"
+    
+def test_query_filters_orders_and_pages_in_sql(db, Author, Book):
+    db.create(Author)
+    db.create(Book)
+    john = Author(name="John Doe", age=43)
+    arash = Author(name="Arash Kun", age=50)
+    db.save_many([john, arash])
+    db.save_many(Book(title=f"Book {i}", published=i % 2 == 0, author=[john, arash][i % 2]) for i in range(10))
+    
+    published = db.query(Book).filter(published=True)
+    assert published.count() == 5
+    assert [book.id for book in published.order_by("-id").limit(2)] == [9, 7]
+    assert [book.id for book in published.order_by("id").limit(2).offset(1)] == [3, 5]
+    assert published.filter(author=john).count() == 5 and not published.filter(author=arash).exists()
+    
+    assert [a.name for a in db.query(Author).filter(age__gte=45)] == ["Arash Kun"]
+    assert db.query(Book).filter(id__in=[1, 2, 99]).count() == 2
+    assert db.query(Book).filter(id__in=[]).count() == 0
+    assert db.query(Book).filter(title__like="Book 1%").first().title == "Book 1"
+    assert db.query(Book).filter(author__isnull=True).count() == 0
+    assert db.query(Book).limit(3).count() == 3
+    
+    page = db.query(Book).order_by("-published", "-id").limit(4).all(related="join")
+    assert [book.id for book in page] == [9, 7, 5, 3]
+    page = db.query(Book).order_by("-published", "-id").after(page[-1]).limit(4).all()
+    assert [book.id for book in page] == [1, 10, 8, 6]
+    assert page[1].author.name == "Arash Kun"
+    
+    # ordered by a column alone, ties still come out the same on every page
+    seen = []
+    page = db.query(Book).order_by("-published").limit(2).all()
+    while page:
+        seen.extend(book.id for book in page)
+        page = db.query(Book).order_by("-published").after(page[-1]).limit(2).all()
+    assert seen == [9, 7, 5, 3, 1, 10, 8, 6, 4, 2]
+    
+    with pytest.raises(AssertionError):
+        db.query(Book).filter(pages__gt=10)
+    with pytest.raises(AssertionError):
+        db.query(Book).filter(title__regex="Book")
+    
+def test_iter_streams_rows_in_chunks(db, Author, Book):
+    import gc
+    import threading
+    
+    db.create(Author)
+    db.create(Book)
+    john = Author(name="John Doe", age=43)
+    db.save(john)
+    db.save_many(Book(title=f"Book {i}", published=True, author=john) for i in range(25))
+    
+    rows = db.iter(Book, chunk_size=10)
+    first = next(rows)
+    assert first.title == "Book 0" and first.author.name == "John Doe"
+    gc.collect()
+    assert sum(isinstance(obj, Book) for obj in gc.get_objects()) <= 10
+    assert len(list(rows)) == 24
+    
+    # the iterator holds its own connection, whichever thread reads it
+    rows = db.iter(Book, chunk_size=10)
+    next(rows)
+    assert db.pool.idle == db.pool.size - 1
+    rest = []
+    thread = threading.Thread(target=lambda: rest.extend(rows))
+    thread.start()
+    thread.join()
+    assert len(rest) == 24 and db.pool.idle == db.pool.size
+    
+    assert next(db.iter(Book, mode="tuples")) == (1, 1, 1, "Book 0")
+    row = next(db.query(Book).filter(title="Book 3").iter(mode="namedtuples"))
+    assert (row.id, row.author_id, row.title) == (4, 1, "Book 3")
+    
+def test_csv_and_json_lines_exports(db, Author):
+    from highball.api import API
+    from highball.orm import csv_stream, jsonl_stream
+    
+    db.create(Author)
+    db.save_many(Author(name=f"Author {i}", age=20 + i) for i in range(250))
+    
+    api = API()
+    
+    @api.route("/authors.csv")
+    def export_csv(req, resp):
+        resp.content_type = "text/csv"
+        resp.stream = csv_stream(db.iter(Author, chunk_size=100))
+        
+    @api.route("/authors.jsonl")
+    def export_jsonl(req, resp):
+        resp.content_type = "application/x-ndjson"
+        resp.stream = jsonl_stream(db.iter(Author, mode="namedtuples"))
+    
+    client = api.test_client()
+    lines = client.get("/authors.csv").text.splitlines()
+    assert lines[:2] == ["id,age,name", "1,20,Author 0"] and len(lines) == 251
+    
+    lines = client.get("/authors.jsonl").text.splitlines()
+    assert json.loads(lines[-1]) == {"id": 250, "age": 269, "name": "Author 249"}
+    
+    assert list(csv_stream([(1, "a")], fields=["id", "name"])) == [b"id,name\r\n1,a\r\n"]
+    assert list(csv_stream([(1, "a")])) == [b"1,a\r\n"]
+    
+def test_indexes_are_created_idempotently(db, Author):
+    from highball.orm import Column, ForeignKey, Index, Table
+    
+    class Review(Table):
+        slug = Column(str, unique=True)
+        stars = Column(int, index=True)
+        body = Column(str)
+        author = ForeignKey(Author)
+        by_author = Index("author", "stars")
+        
+    assert Review._get_index_sql() == [
+        "CREATE INDEX IF NOT EXISTS review_author_id ON review (author_id);",
+        "CREATE INDEX IF NOT EXISTS review_by_author ON review (author_id, stars);",
+        "CREATE UNIQUE INDEX IF NOT EXISTS review_slug ON review (slug);",
+        "CREATE INDEX IF NOT EXISTS review_stars ON review (stars);",
+    ]
+    
+    db.create(Author)
+    db.create(Review)
+    db.create(Review)
+    indexes = {row[0] for row in db.conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {"review_author_id", "review_by_author", "review_slug", "review_stars"} <= indexes
+    
+    john = Author(name="John Doe", age=23)
+    db.save(john)
+    db.save(Review(slug="great", stars=5, body="Great", author=john))
+    with pytest.raises(sqlite3.IntegrityError):
+        db.save(Review(slug="great", stars=1, body="Copy", author=john))
+        
+    # a unique column stays unique when an Index covers it too
+    class Post(Table):
+        slug = Column(str, unique=True)
+        by_slug = Index("slug")
+        
+    class Page(Table):
+        a_slug = Index("slug")
+        slug = Column(str, unique=True)
+        
+    assert Post._get_index_sql() == ["CREATE UNIQUE INDEX IF NOT EXISTS post_by_slug ON post (slug);"]
+    assert Page._get_index_sql() == ["CREATE UNIQUE INDEX IF NOT EXISTS page_a_slug ON page (slug);"]
+        
+    with pytest.raises(AssertionError):
+        class Broken(Table):
+            title = Column(str)
+            by_pages = Index("pages")
+    
+def test_query_plan_check_warns_on_full_scans(tmpdir, Author):
+    from highball.orm import Database, FullScanWarning
+    
+    db = Database(str(tmpdir.join("plans.db")), check_plans=True)
+    db.create(Author)
+    
+    with pytest.warns(FullScanWarning):
+        db.query(Author).filter(name="John Doe").all()
+    assert any("PRIMARY KEY" in detail for detail in db.query(Author).filter(id=1).explain())
+    
+    import warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", FullScanWarning)
+        db.all(Author)
+        db.query(Author).filter(id__in=[1, 2]).count()
+        db.query(Author).order_by("-id").limit(5).all()
+    with pytest.warns(FullScanWarning):
+        db.query(Author).order_by("age").limit(5).all()
+    
+def test_result_cache_reads_through_and_invalidates_on_writes(db, Author, Book):
+    db.create(Author)
+    db.create(Book)
+    cache = db.enable_cache(max_entries=3, ttl=60)
+    john = Author(name="John Doe", age=23)
+    db.save(john)
+    db.save(Book(title="Building an ORM", published=True, author=john))
+    
+    queries = _count_queries(db)
+    assert db.get(Author, id=1).name == "John Doe"
+    assert db.get(Author, id=1) is not db.get(Author, id=1)
+    assert len(queries) == 1
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 1
+    
+    assert db.get(Book, id=1).author.name == "John Doe"
+    john.name = "John Wick"
+    db.update(john)
+    assert db.get(Author, id=1).name == "John Wick"
+    assert db.get(Book, id=1).author.name == "John Wick"
+    
+    assert len(db.query(Author).filter(age=23).all()) == 1
+    db.save(Author(name="Jane Doe", age=23))
+    assert len(db.query(Author).filter(age=23).all()) == 2
+    
+    with db.transaction():
+        db.delete(Author, id=2)
+        assert len(db.query(Author).filter(age=23).all()) == 1
+    assert len(db.query(Author).filter(age=23).all()) == 1
+    
+    for id in range(1, 6):
+        db.query(Author).filter(id=id).all()
+    assert cache.stats()["evictions"] > 0
+    
+    # rows read before a write that commits while they are being read stay out
+    key = (frozenset(["author"]), "query", "author", "SELECT ...", ())
+    version = cache.version(key[0])
+    db.save(Author(name="Jane Roe", age=30))
+    assert not cache.set(key, [(1, 23, "John Wick")], version)
+    assert cache.entries.get(key) is None
+    
+def test_result_cache_generations_are_shared_between_processes(tmpdir, Author):
+    from highball.orm import Database
+    
+    path = str(tmpdir.join("shared.db"))
+    first, second = Database(path), Database(path)
+    first.create(Author)
+    first.save(Author(name="John Doe", age=23))
+    first.enable_cache(shared=True, check_interval=0)
+    second.enable_cache(shared=True, check_interval=0)
+    
+    assert first.get(Author, id=1).name == "John Doe"
+    john = second.get(Author, id=1)
+    john.name = "John Wick"
+    second.update(john)
+    
+    assert first.get(Author, id=1).name == "John Wick"
+    assert first.conn.execute("SELECT generation FROM highball_generations WHERE name = 'author'").fetchone() == (1,)